@@ -171,12 +171,14 @@ EFilenameType FCameraHandler::ParseFilenameType(const FString& Filename)
 	{
 		if (FileExtension == TEXT("png")) return EFilenameType::PngBinary;
 		if (FileExtension == TEXT("bmp")) return EFilenameType::BmpBinary;
+		if (FileExtension == TEXT("jpg")) return EFilenameType::JpgBinary;
 		if (FileExtension == TEXT("npy")) return EFilenameType::NpyBinary;
 	}
 	else
 	{
 		if (FileExtension == TEXT("png")) return EFilenameType::Png;
 		if (FileExtension == TEXT("bmp")) return EFilenameType::Bmp;
+		if (FileExtension == TEXT("jpg")) return EFilenameType::Jpg;
 		if (FileExtension == TEXT("npy")) return EFilenameType::Npy;
 		if (FileExtension == TEXT("exr")) return EFilenameType::Exr;
 	}
@@ -204,6 +206,12 @@ FExecStatus FCameraHandler::SerializeData(const TArray<FColor>& Data, int Width,
 	case EFilenameType::Png:
 		ImageUtil.SavePngFile(Data, Width, Height, Filename);
 		return FExecStatus::OK(Filename);
+	case EFilenameType::JpgBinary:
+		ImageUtil.ConvertToJpg(Data, Width, Height, BinaryData);
+		return FExecStatus::Binary(BinaryData);
+	case EFilenameType::Jpg:
+		ImageUtil.SaveJpgFile(Data, Width, Height, Filename);
+		return FExecStatus::OK(Filename);
 	}
 	return FExecStatus::Error(FString::Printf(TEXT("Invalid filename type, filename %s"), *Filename));
 }
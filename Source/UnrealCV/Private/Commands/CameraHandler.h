@@ -11,6 +11,8 @@ enum EFilenameType
 	PngBinary,
 	NpyBinary,
 	BmpBinary,
+	Jpg,
+	JpgBinary, // Lossy, much cheaper to encode than png, for rgb images such as lit and normal
 	Invalid, // Unrecognized filename type
 };
 
@@ -13,6 +13,7 @@ import os
 # except:
 #     from queue import Queue # for Python 3
 from queue import SimpleQueue
+from collections import deque
 
 
 _L = logging.getLogger(__name__)
@@ -50,26 +51,25 @@ class SocketMessage:
         # rbufsize = -1 # From SocketServer.py
         # rbufsize = 0
         # rfile = sock.makefile('rb', rbufsize)
+        # read the magic and the payload size in one go, 8 bytes in total, instead of two recv calls
+        header = bytearray(8)
+        view = memoryview(header)
+        bytes_read = 0
         try:
             # raw_magic = rfile.read(4) # socket is disconnected or invalid
-            raw_magic = b''
-            while len(raw_magic) < 4:
-                recv_data = sock.recv(4)
-                if not recv_data:
+            while bytes_read < 8:
+                n = sock.recv_into(view[bytes_read:])
+                if not n:
                     # socket closed by server
                     print('Warning: socket disconnected by server')
-                    break
-                raw_magic += recv_data
+                    return None
+                bytes_read += n
         except Exception as e:
             print(f'fail to read raw_magic, exception: {e}')
             _L.debug('Fail to read raw_magic, exception: "%s"', e)
-            raw_magic = None
-
-        if not raw_magic:
-            # _L.debug('socket disconnect by server')
             return None
 
-        magic = struct.unpack(cls.fmt, raw_magic)[0]  # 'I' means unsigned int
+        magic, payload_size = struct.unpack(cls.fmt * 2, header)  # 'I' means unsigned int
         if magic != cls.magic:
             print(
                 'Error: receive a malformat message, the message should start from a four bytes uint32 magic number'
@@ -79,33 +79,20 @@ class SocketMessage:
             )
             print('Actually received magic message: %s', repr(magic))
             return None
-            # The next time it will read four bytes again
 
-        # _L.debug('read payload')
-        # raw_payload_size = rfile.read(4)
-        raw_payload_size = sock.recv(4)
-        if not raw_payload_size:
-            print('Warning: socket disconnected by server')
-            return None
-        # print 'Receive raw payload size: %d, %s' % (len(raw_payload_size), raw_payload_size)
-        payload_size = struct.unpack('I', raw_payload_size)[0]
         # _L.debug('Receive payload size %d', payload_size)
 
         # if the message is incomplete, should wait until all the data received
-        payload = b''
-        remain_size = payload_size
-        while remain_size > 0:
-            # data = rfile.read(remain_size)
-            data = sock.recv(remain_size)
-            if not data:
+        # receive directly into a buffer of the payload size, instead of concatenating the chunks
+        payload = bytearray(payload_size)
+        view = memoryview(payload)
+        bytes_read = 0
+        while bytes_read < payload_size:
+            n = sock.recv_into(view[bytes_read:])
+            if not n:
                 print('recv data is None!')
                 return None
-
-            payload += data
-            bytes_read = len(data)  # len(data) is its string length, but we want length of bytes
-            # print 'bytes_read %d, remain_size %d, read_str %s' % (bytes_read, remain_size, data)
-            assert bytes_read <= remain_size
-            remain_size -= bytes_read
+            bytes_read += n
 
         return payload
 
@@ -139,6 +126,43 @@ class SocketMessage:
             _L.error('Fail to send message %s', e)
             return False
 
+    @classmethod
+    def WrapAndSendPayloads(cls, sock, payloads):
+        """
+        Send a list of payloads with a single sendall call, true if success, false if failed
+        """
+        try:
+            header_fmt = cls.fmt * 2  # magic and payload size
+            data = b''.join(struct.pack(header_fmt, cls.magic, len(payload)) + payload for payload in payloads)
+            sock.sendall(data)
+            return True
+        except Exception as e:
+            print(f'Fail to send message {e}')
+            _L.error('Fail to send message %s', e)
+            return False
+
+
+class BatchResponses:
+    """Iterator over the responses of a batch sent by Client.request_batch_iter"""
+    def __init__(self, recv_data_q, num):
+        self.recv_data_q = recv_data_q
+        self.remain = num
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remain <= 0:
+            raise StopIteration
+        self.remain -= 1
+        return self.recv_data_q.get()
+
+    def close(self):
+        # the responses must be consumed, otherwise they will be returned to the next request
+        while self.remain > 0:
+            self.remain -= 1
+            self.recv_data_q.get()
+
 
 """
 BaseClient send message out and receiving message in a seperate thread.
@@ -164,7 +188,7 @@ class Client:
         """
         self.endpoint = endpoint
         self.sock = None  # if socket == None, means client is not connected
-        self.raw_message_regexp = re.compile(rb'(\d{1,}):(.*)')  # A binary regexp
+        self.raw_message_regexp = re.compile(rb'(\d{1,}):')  # A binary regexp, only match the message id
         # self.message_id = 0
         self.wait_response = threading.Event()
         self.send_message_id = 0
@@ -172,6 +196,14 @@ class Client:
         self.recv_num_q = SimpleQueue()  # inf
         self.recv_data_q = SimpleQueue()  # inf
         self.type = type
+        self.sock_buffer_size = 1 << 20  # 1 MiB socket send/receive buffers
+        # fire-and-forget commands queued by submit, sent in one batch by the flush thread
+        self.flush_interval = 0.001  # seconds to wait after a submit, so that close submits share one write
+        self.submit_q = deque()
+        self.send_lock = threading.RLock()  # keep message ids in order when the flush thread is sending
+        self.flush_wake = threading.Event()  # set by submit, the flush thread sleeps until then
+        self.flush_stop = threading.Event()
+        self.flush_thread = None
 
     # TODO: async send
     def send(self, message):
@@ -184,15 +216,50 @@ class Client:
             _L.error('Fail to send message, client is not connected')
             return False
 
+    def send_batch(self, messages):
+        """Send a list of messages out in one write, return whether the messages were successfully sent"""
+        if self.isconnected():
+            _L.debug('BaseClient: Send %d messages', len(messages))
+            return SocketMessage.WrapAndSendPayloads(self.sock, messages)
+        else:
+            _L.error('Fail to send message, client is not connected')
+            return False
+
+    def _frame_batch(self, batch):
+        """Add message ids to a batch of requests, ready for send_batch. send_message_id is advanced by the caller after the send"""
+        raw_messages = []
+        for i, message in enumerate(batch):
+            if sys.version_info[0] == 3:
+                if not isinstance(message, bytes):
+                    message = message.encode('utf-8')
+
+            raw_messages.append(b'%d:%s' % (self.send_message_id + i, message))
+        return raw_messages
+
+    def _post(self, batch, num):
+        """
+        Send a batch of requests in one write, after the submitted commands which are still in the queue.
+        num is put into recv_num_q for the batch, negative number indicates need results
+        """
+        with self.send_lock:
+            submitted = [self.submit_q.popleft() for _ in range(len(self.submit_q))]
+            # the submitted commands go first in the same write, so the server sees the commands in call order
+            if not self.send_batch(self._frame_batch(submitted + batch)):
+                self.submit_q.extendleft(reversed(submitted))  # keep them for the next flush, the ids are not used
+                assert 0, 'failed send because of socket is closed'
+            self.send_message_id += len(submitted) + len(batch)
+            if submitted:
+                self.recv_num_q.put(len(submitted))  # do not need results
+            if batch:
+                self.recv_num_q.put(num)
+
     def raw_message_handler(self, raw_message):
         match = self.raw_message_regexp.match(raw_message)
 
         if match:
-            [message_id, message_body] = (
-                int(match.group(1)),
-                match.group(2),
-            )
-            message_body = raw_message[len(match.group(1)) + 1 :]
+            message_id = int(match.group(1))
+            del raw_message[:match.end()]  # drop the message id in place, the body is not copied
+            message_body = raw_message
             # Convert to utf-8 if it's not a byte array (as is the case for images)
             try:
                 message_body = message_body.decode('utf-8')
@@ -223,6 +290,13 @@ class Client:
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             else:
                 raise NotImplementedError
+            # large buffers so that images arrive in fewer reads, set before connect to take effect on the tcp window
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.sock_buffer_size)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sock_buffer_size)
+            if self.type == 'inet':
+                # send small requests immediately instead of waiting for Nagle's algorithm
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
             # Make the socket working in the blocking mode
             s.connect(self.endpoint)
             self.sock = s
@@ -265,7 +339,11 @@ class Client:
 
     def disconnect(self):
         """Disconnect from server"""
+        self.flush_stop.set()
+        self.flush_wake.set()  # let the flush thread see the stop
         if self.isconnected():
+            if threading.current_thread() is not getattr(self, 't', None):
+                self.flush()  # the receive thread can not send, it is the one finding the socket closed
             _L.debug(
                 'BaseClient, request disconnect from server in %s',
                 threading.current_thread().name,
@@ -348,19 +426,7 @@ class Client:
         if type(message) is list:
             return self.request_batch_async(message)
 
-        if sys.version_info[0] == 3:
-            if not isinstance(message, bytes):
-                message = message.encode('utf-8')
-
-        raw_message = b'%d:%s' % (self.send_message_id, message)
-        if not self.send(raw_message):
-            assert 0, 'failed send because of socket is closed'
-            # return None
-
-        self.send_message_id += 1
-
-        self.recv_num_q.put(1)
-        # self.message_id += 1
+        self._post([message], 1)
         return None
 
     def request_batch_async(self, batch):
@@ -372,18 +438,7 @@ class Client:
         -------
         None
         """
-        for message in batch:
-            if sys.version_info[0] == 3:
-                if not isinstance(message, bytes):
-                    message = message.encode('utf-8')
-
-            raw_message = b'%d:%s' % (self.send_message_id, message)
-            if not self.send(raw_message):
-                assert 0, 'failed send because of socket is closed'
-            # self.send(raw_message)
-            self.send_message_id += 1
-
-        self.recv_num_q.put(len(batch))
+        self._post(batch, len(batch))
         return None
 
     def request_batch(self, batch):
@@ -403,18 +458,7 @@ class Client:
         >>> client.request_batch(['vget /camera/0/location', 'vget /camera/0/rotation'])
         ['100.0 -100.0 100.0', '0.0 0.0 0.0']
         """
-        for message in batch:
-            if sys.version_info[0] == 3:
-                if not isinstance(message, bytes):
-                    message = message.encode('utf-8')
-
-            raw_message = b'%d:%s' % (self.send_message_id, message)
-            if not self.send(raw_message):
-                assert 0, 'failed send because of socket is closed'
-                # return None
-            self.send_message_id += 1
-
-        self.recv_num_q.put(-len(batch))  # negative number indicates need results
+        self._post(batch, -len(batch))  # negative number indicates need results
 
         batch_res = []
         for i in range(len(batch)):
@@ -423,6 +467,71 @@ class Client:
 
         return batch_res
 
+    def request_batch_iter(self, batch):
+        """
+        Send a batch of requests to server and yield the responses one by one as soon as they are received.
+        The batch is sent right away, before the first response is asked for.
+        Parameters
+        ----------
+        batch : list
+            a list of requests, each request is a string, such as ['command1', 'command2', ...]
+        Returns
+        -------
+        iterator
+            yields the responses in the order of the requests.
+            If the iterator is closed early, the remaining responses are still read and dropped.
+            Do not send other requests with this client until the iterator is exhausted or closed,
+            they would read the responses of this batch.
+
+        Examples
+        --------
+        >>> for res in client.request_batch_iter(['vget /camera/0/lit png', 'vget /camera/1/lit png']):
+        ...     img = read_png(res)
+        """
+        self._post(batch, -len(batch))  # negative number indicates need results
+        return BatchResponses(self.recv_data_q, len(batch))
+
+    def submit(self, message):
+        """
+        Queue a request (or a list of requests) without waiting for any reply.
+        The queued requests are sent in one batch by a background thread flush_interval seconds after the submit,
+        or in the same write as the next request, so they always reach the server in call order.
+        The thread sleeps while nothing is queued. Call disconnect() before exit, it sends the requests which are still queued.
+        If a send fails, the requests stay queued and are sent by the next flush.
+
+        Examples
+        --------
+        >>> client.submit('vset /object/Cube/location 0 0 100')
+        >>> client.flush()
+        """
+        if type(message) is list:
+            self.submit_q.extend(message)
+        else:
+            self.submit_q.append(message)
+        if self.flush_thread is None or not self.flush_thread.is_alive():
+            self.flush_stop.clear()
+            self.flush_thread = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flush_thread.start()
+        self.flush_wake.set()
+        return True
+
+    def flush(self):
+        """Send the queued requests now"""
+        if self.submit_q:
+            self._post([], 0)
+
+    def flush_loop(self):
+        while True:
+            self.flush_wake.wait()  # idle until the next submit
+            if self.flush_stop.wait(self.flush_interval):  # collect the submits of the next flush_interval
+                break
+            self.flush_wake.clear()
+            try:
+                if self.submit_q and self.isconnected():
+                    self.flush()
+            except Exception as e:  # keep the thread alive, the next submit tries again
+                _L.error('Fail to flush the submitted requests: %s', e)
+
     def request(self, message, timeout=5):
         """
         Send a request to server and wait util get a response from server or timeout.
@@ -455,19 +564,7 @@ class Client:
         if type(message) is list:
             return self.request_batch(message)
 
-        if sys.version_info[0] == 3:
-            if not isinstance(message, bytes):
-                message = message.encode('utf-8')
-
-        raw_message = b'%d:%s' % (self.send_message_id, message)
-        # _L.debug('Request: %s', raw_message.decode("utf-8"))
-        if not self.send(raw_message):
-            assert 0, 'failed send because of socket is closed'
-            # return None
-
-        self.send_message_id += 1
-
-        self.recv_num_q.put(-1)  # negative number indicates need results
+        self._post([message], -1)  # negative number indicates need results
         message = self.recv_data_q.get()
 
         return message
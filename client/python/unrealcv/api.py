@@ -5,15 +5,22 @@ import math
 import time
 import os
 import re
-from io import BytesIO
-import PIL.Image
+import struct
 import sys
-from unrealcv.util import ResChecker, time_it
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+from unrealcv.util import ResChecker, time_it, load_npy
 import warnings
 
 "APIs for UnrealCV, a toolkit for using Unreal Engine (UE) in Python."
 
 class UnrealCv_API(object):
+    mask_threshold = 3  # default color tolerance of object masks
+    bbox_scan_min_objects = 32  # below this number of objects, inRange per object is faster than scanning all colors
+
     def __init__(self, port, ip, resolution, mode='tcp'):
         # if ip == '127.0.0.1':
         #     self.docker = False
@@ -25,7 +32,22 @@ class UnrealCv_API(object):
         self.decoder = MsgDecoder(resolution)
         self.checker = ResChecker()
         self.obj_dict = dict()
+        self._mask_ranges = dict()  # obj -> (lower, upper) BGR range of its mask color
+        self._used_colors = set()  # packed rgb of the colors assigned to objects, to pick unused colors quickly
+        self._lower_buf = np.empty(3, dtype=np.uint8)  # reused by get_mask for non-default thresholds
+        self._upper_buf = np.empty(3, dtype=np.uint8)
+        self._depth_scale = 0.0  # running max of the shown depth images
+        self._pipe = None  # commands buffered by pipeline(), None if no pipeline is active
+        self._attr_cache = dict()  # (obj, attr) -> value, for attributes only changed through this client, e.g. scale, size, uclass
+        self._obj_pose = dict()  # obj -> {'location': loc, 'rotation': rot} last set by this client
         self.cam = dict()
+        self._num_cameras = None  # cached number of cameras, cleared by refresh_map
+        self._objects = None  # cached object list, cleared by refresh_map
+        self._decode_pool = ThreadPoolExecutor(max_workers=os.cpu_count())  # decode images in parallel
+        # one worker, so that overlapping batch_cmd_async calls do not read each other's replies from the client
+        self._request_pool = ThreadPoolExecutor(max_workers=1)
+        # (batch size, latency in ms) of the recent batch_cmd calls, only recorded if UNREALCV_PROFILE is set
+        self._batch_stats = deque(maxlen=1000) if os.environ.get('UNREALCV_PROFILE') else None
         # build a client to connect to the env
         self.client = self.connect(ip, port, mode)
         self.client.message_handler = self.message_handler
@@ -39,9 +61,12 @@ class UnrealCv_API(object):
                 unix_socket_path = os.path.join('/tmp/unrealcv_{port}.socket'.format(port=port))  # clean the old socket
                 os.remove(unix_socket_path) if os.path.exists(unix_socket_path) else None
                 client.disconnect() # disconnect the client for creating a new socket in linux
-                time.sleep(2)
-                if unix_socket_path is not None and os.path.exists(unix_socket_path):
-                    client = unrealcv.Client(unix_socket_path, 'tcp')
+                for _ in range(20):  # wait up to 2s for the server to create the new socket
+                    if os.path.exists(unix_socket_path):
+                        break
+                    time.sleep(0.1)
+                if os.path.exists(unix_socket_path):
+                    client = unrealcv.Client(unix_socket_path, 'unix')
                 else:
                     client = unrealcv.Client((ip, port)) # reconnect to the tcp socket
                 client.connect()
@@ -49,9 +74,34 @@ class UnrealCv_API(object):
                 warnings.warn('unix socket mode is not supported in this platform, switch to tcp mode.')
         return client
 
+    def close(self):  # disconnect from the env and stop the request and decode threads
+        self._request_pool.shutdown(wait=True)
+        self._decode_pool.shutdown(wait=True)
+        self.client.disconnect()
+
     def init_map(self):
-        self.cam = self.get_camera_config()
-        self.obj_dict = self.build_color_dict(self.get_objects())
+        # two round trips in total: the camera and object lists, then all camera configs and object colors
+        if self._num_cameras is None or self._objects is None:
+            cameras, objects = self.client.request(['vget /cameras', 'vget /objects'])
+            self._num_cameras = len(cameras.split())
+            self._objects = objects.split()
+        objects = self.get_objects()
+        cam_cmds, cam_decoders = self._camera_config_cmds(self._num_cameras)
+        color_cmds = [self.get_obj_color(obj, return_cmd=True) for obj in objects]
+        res = self.batch_cmd(cam_cmds + color_cmds, cam_decoders + [self.decoder.string2color] * len(objects))
+        self.cam = self._camera_config_from(res[:len(cam_cmds)], self._num_cameras)
+        self._set_color_dict(dict(zip(objects, res[len(cam_cmds):])))
+
+    def refresh_map(self):  # drop the cached cameras and objects and query them again
+        self._num_cameras = None
+        self._objects = None
+        self._attr_cache.clear()
+        self.init_map()
+
+    def invalidate(self, obj=None, attr=None):  # drop cached object attributes, all of them by default
+        for key in list(self._attr_cache):
+            if (obj is None or key[0] == obj) and (attr is None or key[1] == attr):
+                del self._attr_cache[key]
 
     def camera_info(self):
         return self.cam
@@ -59,65 +109,146 @@ class UnrealCv_API(object):
     def config_ue(self, resolution=(320, 240), low_quality=False, disable_all_screen_messages=True):
         self.check_connection()
         [w, h] = resolution
-        self.client.request(f'vrun setres {w}x{h}w', -1)  # set resolution of the display window
+        self._issue(f'vrun setres {w}x{h}w')  # set resolution of the display window
         if disable_all_screen_messages:
-            self.client.request('DisableAllScreenMessages', -1)  # disable all screen messages
+            self._issue('DisableAllScreenMessages')  # disable all screen messages
         if low_quality:
-            self.client.request('vrun sg.ShadowQuality 0', -1)  # set shadow quality to low
-            self.client.request('vrun sg.TextureQuality 0', -1)  # set texture quality to low
-            self.client.request('vrun sg.EffectsQuality 0', -1)  # set effects quality to low
+            self._issue('vrun sg.ShadowQuality 0')  # set shadow quality to low
+            self._issue('vrun sg.TextureQuality 0')  # set texture quality to low
+            self._issue('vrun sg.EffectsQuality 0')  # set effects quality to low
         time.sleep(0.1)
 
     def message_handler(self, message):
         msg = message
         print(msg)
 
-    def check_connection(self):
+    def check_connection(self, timeout=None, backoff=0.1):
+        # reconnect until connected, wait backoff * 2**i seconds (at most 1s) between tries
+        # raise ConnectionError after timeout seconds, wait forever if timeout is None
+        start = time.time()
+        delay = backoff
         while self.client.isconnected() is False:
+            if timeout is not None and time.time() - start > timeout:
+                raise ConnectionError(f'UnrealCV server is not running after {timeout}s')
             warnings.warn('UnrealCV server is not running. Please try again')
-            time.sleep(1)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
             self.client.connect()
 
     def get_camera_config(self):
         num_cameras = self.get_camera_num()
+        cmds, decoders = self._camera_config_cmds(num_cameras)
+        res = self.batch_cmd(cmds, decoders)
+        return self._camera_config_from(res, num_cameras)
+
+    def _camera_config_cmds(self, num_cameras):
+        # query location, rotation and fov of all cameras in one batch
+        cam_ids = range(num_cameras)
+        cmds = [self.get_cam_location(i, return_cmd=True) for i in cam_ids] + \
+               [self.get_cam_rotation(i, return_cmd=True) for i in cam_ids] + \
+               [self.get_cam_fov(i, return_cmd=True) for i in cam_ids]
+        decoders = [self.decoder.string2floats] * (2 * num_cameras) + [self.decoder.string2float] * num_cameras
+        return cmds, decoders
+
+    def _camera_config_from(self, res, num_cameras):  # scatter the decoded batch of _camera_config_cmds into the camera dict
+        cam_ids = range(num_cameras)
         cam = dict()
-        for i in range(num_cameras):
+        for i in cam_ids:
             cam[i] = dict(
-                 location=self.get_cam_location(i, syns=False),
-                 rotation=self.get_cam_rotation(i, syns=False),
-                 fov=self.get_cam_fov(i)
+                 location=res[i],
+                 rotation=res[num_cameras + i],
+                 fov=res[2 * num_cameras + i]
             )
         return cam
 
-    def get_camera_num(self):
-        return len(self.client.request('vget /cameras').split())
-
-    def get_objects(self):  # get all objects name in the map
+    def get_objects(self, use_cache=True):  # get all objects name in the map
+        if use_cache and self._objects is not None:
+            return list(self._objects)
         objects = self.client.request('vget /objects').split()
-        return objects
+        self._objects = objects
+        return list(objects)
 
     # batch_functions for multiple commands
     def batch_cmd(self, cmds, decoders, **kwargs):
         # cmds = [cmd1, cmd2, ...]
         # decoder is a list of decoder functions
-        res_list = self.client.request(cmds)
+        if self._batch_stats is None:
+            res_list = self.client.request(cmds)
+        else:
+            start = time.perf_counter()
+            res_list = self.client.request(cmds)
+            self._batch_stats.append((len(cmds), (time.perf_counter() - start) * 1000))
         if decoders is None: # vset commands do not decode return
             return res_list
         for i, res in enumerate(res_list):
             res_list[i] = decoders[i](res, **kwargs)
         return res_list
 
+    def dump_stats(self):  # print the p50/p95 batch size and latency of the recent batch_cmd calls
+        if not self._batch_stats:
+            print('No batch stats, set UNREALCV_PROFILE=1 to record them')
+            return
+        sizes, latencies = np.array(self._batch_stats).T
+        print(f'batch_cmd: {len(sizes)} calls, '
+              f'size p50 {np.percentile(sizes, 50):.0f} p95 {np.percentile(sizes, 95):.0f}, '
+              f'latency p50 {np.percentile(latencies, 50):.2f}ms p95 {np.percentile(latencies, 95):.2f}ms')
+
+    async def batch_cmd_async(self, cmds, decoders, **kwargs):
+        # asyncio version of batch_cmd, the responses are decoded concurrently in the executor
+        # so that decoding of one image overlaps with the others instead of running one by one
+        # the requests of gathered calls run one after another in _request_pool, the client reads replies in order
+        # note: do not call the blocking api from other threads at the same time, they share the same client
+        loop = asyncio.get_running_loop()
+        res_list = await loop.run_in_executor(self._request_pool, self.client.request, cmds)
+        if decoders is None:  # vset commands do not decode return
+            return res_list
+        tasks = [loop.run_in_executor(self._decode_pool, functools.partial(decoder, res, **kwargs))
+                 for decoder, res in zip(decoders, res_list)]
+        return list(await asyncio.gather(*tasks))
+
+    @contextmanager
+    def pipeline(self):
+        # buffer the async (vset) commands issued inside the with block and send them in one batch on exit
+        # e.g. with api.pipeline(): [api.set_obj_color(obj, color) for obj, color in colors.items()]
+        # note: the buffered commands reach the server after the block, getters inside the block see the old state
+        if self._pipe is not None:  # already in a pipeline
+            yield self
+            return
+        self._pipe = []
+        try:
+            yield self
+        finally:
+            pipe, self._pipe = self._pipe, None
+            if pipe:
+                self.client.request(pipe, -1)
+
+    def _issue(self, cmd):
+        # send an async command (or a list of commands) without waiting for the response
+        if self._pipe is not None:
+            if type(cmd) is list:
+                self._pipe.extend(cmd)
+            else:
+                self._pipe.append(cmd)
+            return True
+        return self.client.submit(cmd)  # queued, sent by the client in one batch before the next request
+
+    def _request_with_retry(self, cmd, max_tries=5, backoff=0.01):
+        # request until a response is received, wait backoff * 2**i seconds between tries
+        for i in range(max_tries):
+            res = self.client.request(cmd)
+            if res is not None:
+                return res
+            time.sleep(backoff * 2**i)
+        raise ConnectionError(f'No response for "{cmd}" after {max_tries} tries')
+
     def save_image(self, cam_id, viewmode, path, return_cmd=False):
         # Note: depth is in npy format
-        cmd = f'vget /camera/{cam_id}/{viewmode} {path}'
-        if return_cmd:
-            return cmd
         # check file extension
         try:
             if viewmode == 'depth':
-                expect_extension = 'npy'
+                expect_extension = ['.npy']
             else:
-                expect_extension = ['bmp', 'png']
+                expect_extension = ['.bmp', '.png', '.jpg']  # splitext keeps the dot
             if not self.checker.is_expected_file_extension(path, expect_extension):
                 raise ValueError(f'Invalid file extension for {viewmode} image, it should be {expect_extension}',)
         except ValueError as e:
@@ -126,7 +257,9 @@ class UnrealCv_API(object):
             else:
                 path += '.png'
 
-        self.client.request(cmd)
+        cmd = f'vget /camera/{cam_id}/{viewmode} {path}'
+        if return_cmd:
+            return cmd
         img_dirs = self.client.request(cmd)
 
         return img_dirs
@@ -134,7 +267,7 @@ class UnrealCv_API(object):
     def get_image(self, cam_id, viewmode, mode='bmp', return_cmd=False, show=False):
         # cam_id:0 1 2 ...
         # viewmode:lit, normal, object_mask, depth
-        # mode: bmp, png, npy
+        # mode: bmp, png, jpg, npy
         # Note: depth is in npy format
         if viewmode == 'depth':
             return self.get_depth(cam_id, return_cmd=return_cmd, show=show)
@@ -147,6 +280,34 @@ class UnrealCv_API(object):
             cv2.waitKey(1)
         return image
 
+    def make_image_fetcher(self, cam_id, viewmode, mode='bmp', inverse=False):
+        # return a function that gets one image, the command and the decoder are resolved once
+        # for tight capture loops, e.g. fetch = api.make_image_fetcher(0, 'lit'); img = fetch()
+        if viewmode == 'depth':
+            mode = 'npy'
+        cmd = f'vget /camera/{cam_id}/{viewmode} {mode}'
+        request = self.client.request
+        if mode == 'npy':
+            decode = functools.partial(self.decoder.decode_depth, inverse=inverse)
+        else:
+            decode = self.decoder.decode_map[mode]
+
+        def fetch():
+            return decode(request(cmd))
+        return fetch
+
+    def get_image_async(self, cam_id, viewmode, mode='bmp', inverse=False):
+        # request the image and decode it in the thread pool, return a Future of the image
+        # the next command can be sent while the image is decoding, e.g.
+        # future = api.get_image_async(0, 'lit'); api.set_cam_location(0, loc); img = future.result()
+        if viewmode == 'depth':
+            mode = 'npy'
+        cmd = f'vget /camera/{cam_id}/{viewmode} {mode}'
+        return self.decode_img_async(self.client.request(cmd), mode, inverse)
+
+    def decode_img_async(self, res, mode, inverse=False):  # decode an image response in the thread pool, return a Future
+        return self._decode_pool.submit(self.decoder.decode_img, res, mode, inverse)
+
     def get_depth(self, cam_id, inverse=False, return_cmd=False, show=False):  # get depth from unrealcv in npy format
         cmd = f'vget /camera/{cam_id}/depth npy'
         if return_cmd:
@@ -154,60 +315,87 @@ class UnrealCv_API(object):
         res = self.client.request(cmd)
         depth = self.decoder.decode_depth(res, inverse)
         if show:
-            cv2.imshow('image', depth/depth.max())  # normalize the depth image
-            cv2.waitKey(10)
+            # normalize the depth image by the largest depth seen so far, converted to uint8 in one pass
+            self._depth_scale = max(self._depth_scale, float(depth.max()))
+            cv2.imshow('image', cv2.convertScaleAbs(depth, alpha=255.0 / max(self._depth_scale, 1e-6)))
+            cv2.waitKey(1)  # only pumps the gui events, same as get_image
         return depth
 
     def get_image_multicam(self, cam_ids, viewmode='lit', mode='bmp', inverse=True):
         # get image from multiple cameras with the same viewmode
         # viewmode : {'lit', 'depth', 'normal', 'object_mask'}
-        # mode : {'bmp', 'npy', 'png'}
+        # mode : {'bmp', 'npy', 'png', 'jpg'}
         # inverse : whether to inverse the depth
         cmds = [self.get_image(cam_id, viewmode, mode, return_cmd=True) for cam_id in cam_ids]
         decoders = [self.decoder.decode_img for i in cam_ids]
         img_list = self.batch_cmd(cmds, decoders, mode=mode, inverse=inverse)
         return img_list
 
+    def get_image_multicam_stream(self, cam_ids, viewmode='lit', mode='bmp', inverse=True):
+        # streaming version of get_image_multicam, return an iterator of the images in the order of cam_ids
+        # the commands are sent right away, each image is decoded in the thread pool as soon as its response is received
+        # note: do not send other requests until the stream is exhausted or closed, they would read its responses
+        cmds = [self.get_image(cam_id, viewmode, mode, return_cmd=True) for cam_id in cam_ids]
+        responses = self.client.request_batch_iter(cmds)
+        return ImageStream(responses, functools.partial(self.decode_img_async, mode=mode, inverse=inverse))
+
+    async def get_image_multicam_async(self, cam_ids, viewmode='lit', mode='bmp', inverse=True):
+        # asyncio version of get_image_multicam, e.g. asyncio.run(api.get_image_multicam_async([0, 1]))
+        cmds = [self.get_image(cam_id, viewmode, mode, return_cmd=True) for cam_id in cam_ids]
+        decoders = [self.decoder.decode_img for i in cam_ids]
+        img_list = await self.batch_cmd_async(cmds, decoders, mode=mode, inverse=inverse)
+        return img_list
+
     def get_image_multimodal(self, cam_id, viewmodes=['lit', 'depth'], modes=['bmp', 'npy']): # get rgb and depth image
         # default is to get RGB-D image
         cmds = [self.get_image(cam_id, viewmode, mode, return_cmd=True) for viewmode, mode in zip(viewmodes, modes)]
-        decoders = [self.decoder.decode_map[mode] for mode in modes]
-        res = self.batch_cmd(cmds, decoders)
+        res_list = self.client.request(cmds)
+        futures = [self._decode_pool.submit(self.decoder.decode_map[mode], res) for res, mode in zip(res_list, modes)]
+        res = [future.result() for future in futures]
         concat_img = np.concatenate(res, axis=2)
         return concat_img
 
+    def get_images_batch(self, cam_ids, viewmodes=['lit'], mode='bmp', inverse=False):
+        # get every viewmode of every camera in one batch, return [[img of each viewmode] for each camera]
+        # depth is always in npy format, the other viewmodes use mode
+        cam_info = {cam_id: {viewmode: {'mode': 'npy' if viewmode == 'depth' else mode, 'inverse': inverse, 'img': None}
+                             for viewmode in viewmodes}
+                    for cam_id in cam_ids}
+        cam_info = self.get_img_batch(cam_info)
+        return [[vm_dict['img'] for vm_dict in cam_info[cam_id].values()] for cam_id in cam_ids]
+
     def get_img_batch(self, cam_info):
         # get image from multiple cameras with the same viewmode
         # viewmode : {'lit', 'depth', 'normal', 'object_mask'}
-        # mode : {'bmp', 'npy', 'png'}
+        # mode : {'bmp', 'npy', 'png', 'jpg'}
         # inverse : whether to inverse the depth
         # one camera id can be of multiple viewmodes, but one viewmode can only have one encoding mode
         # cam_info : {cam_id: {viewmode: {'mode': 'bmp', 'inverse': True, 'img': None}}}
         cmd_list = []
         # prepare command list
-        for cam_id in cam_info.keys():
-            for viewmode in cam_info[cam_id].keys():
-                mode = cam_info[cam_id][viewmode]['mode']
-                cmd_list.append(self.get_image(cam_id, viewmode, mode, return_cmd=True))
-
-        res_list = self.client.request(cmd_list)
-        # decode images and store in cam_info
-        for cam_id in cam_info.keys():
-            for viewmode in cam_info[cam_id].keys():
-                mode = cam_info[cam_id][viewmode]['mode']
-                inverse = cam_info[cam_id][viewmode]['inverse']
-                cam_info[cam_id][viewmode]['img'] = self.decoder.decode_img(res_list.pop(0), mode, inverse)
+        for cam_id, cam_dict in cam_info.items():
+            for viewmode, vm_dict in cam_dict.items():
+                cmd_list.append(self.get_image(cam_id, viewmode, vm_dict['mode'], return_cmd=True))
+
+        res_iter = iter(self.client.request(cmd_list))
+        # decode images in the thread pool and store in cam_info
+        futures = []
+        for cam_dict in cam_info.values():
+            for vm_dict in cam_dict.values():
+                futures.append(self.decode_img_async(next(res_iter), vm_dict['mode'], vm_dict['inverse']))
+        futures = iter(futures)
+        for cam_dict in cam_info.values():
+            for vm_dict in cam_dict.values():
+                vm_dict['img'] = next(futures).result()
         return cam_info
 
 
     def set_cam_pose(self, cam_id, pose):  # set camera pose, pose = [x, y, z, pitch, yaw, roll]
         [x, y, z, roll, yaw, pitch] = pose
-        self.set_cam_rotation(cam_id, [roll, yaw, pitch])
-        self.set_cam_location(cam_id, [x, y, z])
-        # cmd = f'vset /camera/{cam_id}/pose {x} {y} {z} {pitch} {yaw} {roll}'
-        # self.client.request(cmd, -1)
-        self.cam[cam_id]['location'] = [x, y, z]
-        self.cam[cam_id]['rotation'] = [roll, yaw, pitch]
+        # send rotation and location in one batch, the server has no combined pose command
+        cmds = [self.set_cam_rotation(cam_id, [roll, yaw, pitch], return_cmd=True),
+                self.set_cam_location(cam_id, [x, y, z], return_cmd=True)]
+        self._issue(cmds)
 
     def get_cam_pose(self, cam_id, mode='hard'):  # get camera pose, pose = [x, y, z, roll, yaw, pitch]
         if mode == 'soft':
@@ -216,30 +404,44 @@ class UnrealCv_API(object):
             return pose
         if mode == 'hard':
             cmds = [self.get_cam_location(cam_id, return_cmd=True), self.get_cam_rotation(cam_id, return_cmd=True)]
-            decoders = [self.decoder.decode_map[self.decoder.cmd2key(cmd)] for cmd in cmds]
+            decoders = [self.decoder.string2floats] * 2  # location, rotation
             res = self.batch_cmd(cmds, decoders)
             self.cam[cam_id]['location'] = res[0]
             self.cam[cam_id]['rotation'] = res[1]
             return res[0] + res[1]
 
-    def set_cam_fov(self, cam_id, fov):  # set camera field of view (fov)
-        if fov == self.cam[cam_id]['fov']:
+    def set_cam_fov(self, cam_id, fov, return_cmd=False):  # set camera field of view (fov)
+        if not return_cmd and fov == self.cam[cam_id]['fov']:
             return fov
         cmd = f'vset /camera/{cam_id}/fov {fov}'
-        self.client.request(cmd, -1)
         self.cam[cam_id]['fov'] = fov
+        if return_cmd:
+            return cmd
+        self._issue(cmd)
         return fov
 
-    def get_cam_fov(self, cam_id):  # set camera field of view (fov)
+    def get_cam_fov(self, cam_id, return_cmd=False, refresh=False):  # get camera field of view (fov)
+        # fov is only changed by set_cam_fov, so the cached value is returned unless refresh=True
         cmd = f'vget /camera/{cam_id}/fov'
-        fov = self.client.request(cmd)
+        if return_cmd:
+            return cmd
+        if not refresh and self.cam.get(cam_id, {}).get('fov') is not None:
+            return self.cam[cam_id]['fov']
+        fov = self.decoder.string2float(self.client.request(cmd))
+        if cam_id in self.cam:
+            self.cam[cam_id]['fov'] = fov
         return fov
 
-    def set_cam_location(self, cam_id, loc):  # set camera location, loc=[x,y,z]
+    def set_cam_location(self, cam_id, loc, return_cmd=False, skip_unchanged=False):  # set camera location, loc=[x,y,z]
+        # skip_unchanged: do not send the command if loc equals the cached location
+        if skip_unchanged and not return_cmd and self.is_same_value(self.cam[cam_id]['location'], loc):
+            return
         [x, y, z] = loc
         cmd = f'vset /camera/{cam_id}/location {x} {y} {z}'
-        self.client.request(cmd, -1)
-        self.cam[cam_id]['location'] = loc
+        self.cam[cam_id]['location'] = list(loc)  # a copy, trajectory loops often reuse one list
+        if return_cmd:
+            return cmd
+        self._issue(cmd)
 
     def get_cam_location(self, cam_id, newest=True, return_cmd=False, syns=True):
         # get camera location, loc=[x,y,z]
@@ -248,9 +450,7 @@ class UnrealCv_API(object):
             cmd = f'vget /camera/{cam_id}/location'
             if return_cmd:
                 return cmd
-            res = None
-            while res is None:
-                res = self.client.request(cmd)
+            res = self._request_with_retry(cmd)
             res = self.decoder.string2floats(res)
             if syns:
                 self.cam[cam_id]['location'] = res
@@ -258,14 +458,17 @@ class UnrealCv_API(object):
             return self.cam[cam_id]['location']
         return res
 
-    def set_cam_rotation(self, cam_id, rot, rpy=False):  # set camera rotation, rot = [roll, yaw, pitch]
-        if rpy:
-            [roll, yaw, pitch] = rot
-        else:
-            [pitch, yaw, roll] = rot
-        cmd = f'vset /camera/{cam_id}/rotation {pitch} {yaw} {roll}'
-        self.client.request(cmd, -1)
-        self.cam[cam_id]['rotation'] = [pitch, yaw, roll]
+    def set_cam_rotation(self, cam_id, rot, rpy=False, return_cmd=False, skip_unchanged=False):  # set camera rotation, rot = [roll, yaw, pitch]
+        # skip_unchanged: do not send the command if rot equals the cached rotation
+        if rpy:  # reorder to [pitch, yaw, roll]
+            rot = [rot[2], rot[1], rot[0]]
+        if skip_unchanged and not return_cmd and self.is_same_value(self.cam[cam_id]['rotation'], rot):
+            return
+        cmd = f'vset /camera/{cam_id}/rotation {rot[0]} {rot[1]} {rot[2]}'
+        self.cam[cam_id]['rotation'] = list(rot)
+        if return_cmd:
+            return cmd
+        self._issue(cmd)
 
     def get_cam_rotation(self, cam_id, newest=True, return_cmd=False, syns=True):
         # get camera rotation, rot = [pitch, yaw, roll]
@@ -274,10 +477,8 @@ class UnrealCv_API(object):
             cmd = f'vget /camera/{cam_id}/rotation'
             if return_cmd:
                 return cmd
-            res = None
-            while res is None:
-                res = self.client.request(cmd)
-            res = [float(i) for i in res.split()]
+            res = self._request_with_retry(cmd)
+            res = self.decoder.string2floats(res)
             if syns:
                 self.cam[cam_id]['rotation'] = res
             return res
@@ -298,11 +499,12 @@ class UnrealCv_API(object):
         pitch_exp = (self.cam[cam_id]['rotation'][0] + pitch) % 360
         assert abs(height) < distance, 'height should be smaller than distance'
         if height != 0:
-            distance_plane = np.sqrt(distance**2 - height**2)
+            distance_plane = math.sqrt(distance**2 - height**2)
         else:
             distance_plane = distance
-        delt_x = distance_plane * math.cos(yaw_exp / 180.0 * math.pi)
-        delt_y = distance_plane * math.sin(yaw_exp / 180.0 * math.pi)
+        yaw_rad = math.radians(yaw_exp)
+        delt_x = distance_plane * math.cos(yaw_rad)
+        delt_y = distance_plane * math.sin(yaw_rad)
 
         location_now = self.get_cam_location(cam_id)
         location_exp = [location_now[0] + delt_x, location_now[1]+delt_y, location_now[2]+height]
@@ -320,44 +522,92 @@ class UnrealCv_API(object):
             return True
 
     def get_distance(self, pos_now, pos_exp, n=2):  # get distance between two points, n is the dimension
-        error = np.array(pos_now[:n]) - np.array(pos_exp[:n])
-        distance = np.linalg.norm(error)
-        return distance
+        # plain float math, numpy arrays are much slower for 2 or 3 elements
+        # math.hypot only takes more than 2 arguments since python 3.8
+        if n == 2:
+            return math.hypot(pos_now[0] - pos_exp[0], pos_now[1] - pos_exp[1])
+        if n == 3:
+            dx, dy, dz = pos_now[0] - pos_exp[0], pos_now[1] - pos_exp[1], pos_now[2] - pos_exp[2]
+            return math.sqrt(dx * dx + dy * dy + dz * dz)
+        return math.sqrt(sum((a - b) * (a - b) for a, b in zip(pos_now[:n], pos_exp[:n])))
 
     def set_keyboard(self, key, duration=0.01):  # Up Down Left Right
         cmd = 'vset /action/keyboard {key} {duration}'
-        return self.client.request(cmd.format(key=key, duration=duration), -1)
+        return self._issue(cmd.format(key=key, duration=duration))
 
     def get_obj_color(self, obj, return_cmd=False):  # get object color in object mask, color = [r,g,b]
         cmd = f'vget /object/{obj}/color'
         if return_cmd:
             return cmd
         res = self.client.request(cmd)
-        return self.decoder.string2color(res)[:-1]
+        return self.decoder.string2color(res)  # [r,g,b], string2color drops the alpha
 
-    def set_obj_color(self, obj, color, return_cmd=False):  # set object color in object mask, color = [r,g,b]
+    def set_obj_color(self, obj, color, return_cmd=False, skip_unchanged=False):  # set object color in object mask, color = [r,g,b]
+        # skip_unchanged: do not send the command if color equals the color last set by this client
+        if not return_cmd and skip_unchanged and self.is_same_value(self.obj_dict.get(obj), color):
+            return
         [r, g, b] = color
         cmd = f'vset /object/{obj}/color {r} {g} {b}'
-        self.obj_dict[obj] = color
+        self.obj_dict[obj] = list(color)  # a copy, the caller may modify and reuse its list
+        self._mask_ranges[obj] = self.build_mask_range(color)
+        self._used_colors.add(self.pack_color(color))
         if return_cmd:
             return cmd
-        self.client.request(cmd, -1)  # -1 means async mode
+        self._issue(cmd)  # async mode
 
-    def set_obj_location(self, obj, loc):  # set object location, loc=[x,y,z]
+    def set_obj_location(self, obj, loc, return_cmd=False, skip_unchanged=False):  # set object location, loc=[x,y,z]
+        # skip_unchanged: do not send the command if loc equals the location last set by this client
+        pose = self._obj_pose.setdefault(obj, dict())
+        if not return_cmd and skip_unchanged and self.is_same_value(pose.get('location'), loc):
+            return
         [x, y, z] = loc
         cmd = f'vset /object/{obj}/location {x} {y} {z}'
-        self.client.request(cmd, -1)  # -1 means async mode
+        pose['location'] = list(loc)  # a copy, the caller may modify and reuse its list
+        if return_cmd:
+            return cmd
+        self._issue(cmd)  # async mode
 
-    def set_obj_rotation(self, obj, rot):  # set object rotation, rot = [roll, yaw, pitch]
+    def set_obj_rotation(self, obj, rot, return_cmd=False, skip_unchanged=False):  # set object rotation, rot = [roll, yaw, pitch]
+        # skip_unchanged: do not send the command if rot equals the rotation last set by this client
+        pose = self._obj_pose.setdefault(obj, dict())
+        if not return_cmd and skip_unchanged and self.is_same_value(pose.get('rotation'), rot):
+            return
         [roll, yaw, pitch] = rot
         cmd = f'vset /object/{obj}/rotation {pitch} {yaw} {roll}'
-        self.client.request(cmd, -1)
+        pose['rotation'] = list(rot)
+        if return_cmd:
+            return cmd
+        self._issue(cmd)
+
+    def is_same_value(self, old, new, abs_tol=1e-4):  # compare two vectors, e.g. cached and requested location
+        if old is None or len(old) != len(new):
+            return False
+        return all(math.isclose(a, b, abs_tol=abs_tol) for a, b in zip(old, new))
 
-    def get_mask(self, object_mask, obj, threshold=3):  # get an object's mask
-        [r, g, b] = self.obj_dict[obj]
-        lower_range = np.array([b-threshold, g-threshold, r-threshold])
-        upper_range = np.array([b+threshold, g+threshold, r+threshold])
-        mask = cv2.inRange(object_mask, lower_range, upper_range)
+    def pack_color(self, color):  # pack [r, g, b] into a 24-bit int
+        [r, g, b] = color
+        return (int(r) << 16) | (int(g) << 8) | int(b)
+
+    def build_mask_range(self, color, threshold=None):  # the BGR range of a color in object mask
+        if threshold is None:
+            threshold = self.mask_threshold
+        [r, g, b] = color
+        lower_range = np.clip([b-threshold, g-threshold, r-threshold], 0, 255).astype(np.uint8)
+        upper_range = np.clip([b+threshold, g+threshold, r+threshold], 0, 255).astype(np.uint8)
+        return lower_range, upper_range
+
+    def get_mask(self, object_mask, obj, threshold=None):  # get an object's mask
+        if threshold is None or threshold == self.mask_threshold:
+            mask_range = self._mask_ranges.get(obj)
+            if mask_range is None:
+                mask_range = self._mask_ranges[obj] = self.build_mask_range(self.obj_dict[obj])
+        else:  # fill the preallocated buffers in place
+            [r, g, b] = self.obj_dict[obj]
+            for i, c in enumerate((b, g, r)):
+                self._lower_buf[i] = max(c - threshold, 0)
+                self._upper_buf[i] = min(c + threshold, 255)
+            mask_range = (self._lower_buf, self._upper_buf)
+        mask = cv2.inRange(object_mask, *mask_range)
         return mask
 
     def get_bbox(self, object_mask, obj, normalize=True):  # get an object's bounding box
@@ -365,32 +615,77 @@ class UnrealCv_API(object):
         width = object_mask.shape[1]
         height = object_mask.shape[0]
         mask = self.get_mask(object_mask, obj)
-        nparray = np.array([[[0, 0]]])
-        pixelpointsCV2 = cv2.findNonZero(mask)
-
-        if type(pixelpointsCV2) == type(nparray):  # exist target in image
-            x_min = pixelpointsCV2[:, :, 0].min()
-            x_max = pixelpointsCV2[:, :, 0].max()
-            y_min = pixelpointsCV2[:, :, 1].min()
-            y_max = pixelpointsCV2[:, :, 1].max()
-            if normalize:
-                box = ((x_min/float(width), y_min/float(height)),  # left top
-                       (x_max/float(width), y_max/float(height)))  # right down
-            else:
-                box = [x_min, y_min, x_max-x_min, y_max-y_min]
+        x, y, w, h = cv2.boundingRect(mask)
+
+        if w > 0 and h > 0:  # exist target in image
+            # x_max and y_max are the last pixel of the object, as before
+            box = self._make_box(x, y, x + w - 1, y + h - 1, width, height, normalize)
         else:
-            if normalize:
-                box = ((0, 0), (0, 0))
-            else:
-                box = [0, 0, 0, 0]
+            box = self._make_box(None, None, None, None, width, height, normalize)
 
         return mask, box
 
-    def get_obj_bboxes(self, object_mask, objects, return_dict=False):
+    def _make_box(self, x_min, y_min, x_max, y_max, width, height, normalize=True):
+        if x_min is None:  # no target in image
+            if normalize:
+                return ((0, 0), (0, 0))
+            else:
+                return [0, 0, 0, 0]
+        if normalize:
+            return ((x_min/float(width), y_min/float(height)),  # left top
+                    (x_max/float(width), y_max/float(height)))  # right down
+        else:
+            return [x_min, y_min, x_max-x_min, y_max-y_min]
+
+    def get_color_bboxes(self, object_mask):
+        # get the bounding box of every color in the object mask in a single pass over the image
+        # return colors [[b, g, r], ...] and the corresponding x_min, y_min, x_max, y_max arrays
+        height, width = object_mask.shape[:2]
+        mask = object_mask.astype(np.uint32)
+        packed = ((mask[:, :, 0] << 16) | (mask[:, :, 1] << 8) | mask[:, :, 2]).ravel()
+        order = np.argsort(packed, kind='stable')  # group the pixels by color
+        packed = packed[order]
+        starts = np.flatnonzero(np.r_[True, packed[1:] != packed[:-1]])
+        keys = packed[starts]
+        colors = np.stack([keys >> 16, (keys >> 8) & 0xFF, keys & 0xFF], axis=1).astype(np.int32)
+        xs = order % width
+        ys = order // width
+        x_min = np.minimum.reduceat(xs, starts)
+        x_max = np.maximum.reduceat(xs, starts)
+        y_min = np.minimum.reduceat(ys, starts)
+        y_max = np.maximum.reduceat(ys, starts)
+        return colors, x_min, y_min, x_max, y_max
+
+    def get_obj_bboxes(self, object_mask, objects, return_dict=False, color_bboxes=None):
         #  get objects' bounding boxes in a image given object list, return a list
+        # color_bboxes: the get_color_bboxes(object_mask) result, pass it to scan a frame only once for several object lists
+        height, width = object_mask.shape[:2]
+        if color_bboxes is None:
+            if len(objects) < self.bbox_scan_min_objects:  # the color scan sorts all pixels, only worth it for many objects
+                boxes = [self.get_bbox(object_mask, obj)[1] for obj in objects]
+                return dict(zip(objects, boxes)) if return_dict else boxes
+            color_bboxes = self.get_color_bboxes(object_mask)
+        colors, x_min, y_min, x_max, y_max = color_bboxes
+        if len(objects) == 0:
+            return dict() if return_dict else []
+        ranges = [self._mask_ranges.get(obj) or self.build_mask_range(self.obj_dict[obj]) for obj in objects]
+        lower = np.array([r[0] for r in ranges], dtype=np.int32)[:, None]  # (objects, 1, 3)
+        upper = np.array([r[1] for r in ranges], dtype=np.int32)[:, None]
+        # match all objects against all colors at once, (objects, colors)
+        in_range = np.all((colors >= lower) & (colors <= upper), axis=2)
+        found = in_range.any(axis=1)
+        # merge the boxes of all colors within the mask range of each object
+        big = max(width, height)
+        obj_x_min = np.where(in_range, x_min, big).min(axis=1)
+        obj_y_min = np.where(in_range, y_min, big).min(axis=1)
+        obj_x_max = np.where(in_range, x_max, -1).max(axis=1)
+        obj_y_max = np.where(in_range, y_max, -1).max(axis=1)
         boxes = []
-        for obj in objects:
-            mask, box = self.get_bbox(object_mask, obj)
+        for i in range(len(objects)):
+            if found[i]:
+                box = self._make_box(obj_x_min[i], obj_y_min[i], obj_x_max[i], obj_y_max[i], width, height)
+            else:
+                box = self._make_box(None, None, None, None, width, height)
             boxes.append(box)
         if return_dict:
             return dict(zip(objects, boxes))
@@ -401,115 +696,151 @@ class UnrealCv_API(object):
         color_dict = dict()
         if batch:
             cmds = [self.get_obj_color(obj, return_cmd=True) for obj in objects]
-            decoders = [self.decoder.string2color for _ in objects]
-            res = self.batch_cmd(cmds, decoders)
+            res = self.decoder.strings2colors(self.batch_cmd(cmds, None))
         else:
             res = [self.get_obj_color(obj) for obj in objects]
         for obj, color in zip(objects, res):
             color_dict[obj] = color
-        self.obj_dict = color_dict
+        self._set_color_dict(color_dict)
         return color_dict
 
+    def _set_color_dict(self, color_dict):  # replace the object colors and the mask ranges built from them
+        self.obj_dict = color_dict
+        self._mask_ranges = {obj: self.build_mask_range(color) for obj, color in color_dict.items()}
+        self._used_colors = {self.pack_color(color) for color in color_dict.values()}
+
     def get_obj_location(self, obj, return_cmd=False):  # get object location
         cmd = f'vget /object/{obj}/location'
         if return_cmd:
             return cmd
-        res = None
-        while res is None:
-            res = self.client.request(cmd)
+        res = self._request_with_retry(cmd)
         return self.decoder.string2floats(res)
 
     def get_obj_rotation(self, obj, return_cmd=False):  # get object rotation
         cmd = f'vget /object/{obj}/rotation'
         if return_cmd:
             return cmd
-        res = None
-        while res is None:
-            res = self.client.request(cmd)
+        res = self._request_with_retry(cmd)
         return self.decoder.string2floats(res)
 
     def get_obj_pose(self, obj):  # get object pose
         cmds = [self.get_obj_location(obj, return_cmd=True), self.get_obj_rotation(obj, return_cmd=True)]
-        decoders = [self.decoder.decode_map[self.decoder.cmd2key(cmd)] for cmd in cmds]
+        decoders = [self.decoder.string2floats] * 2  # location, rotation
         res = self.batch_cmd(cmds, decoders)
         return res[0] + res[1]
 
     def build_pose_dic(self, objects):  # build a pose dictionary for objects
+        num_objects = len(objects)
+        cmds = [self.get_obj_location(obj, return_cmd=True) for obj in objects] + \
+               [self.get_obj_rotation(obj, return_cmd=True) for obj in objects]
+        decoders = [self.decoder.string2floats] * (2 * num_objects)
+        res = self.batch_cmd(cmds, decoders)
         pose_dic = dict()
-        for obj in objects:
-            pose = self.get_obj_location(obj)
-            pose.extend(self.get_obj_rotation(obj))
-            pose_dic[obj] = pose
+        for i, obj in enumerate(objects):
+            pose_dic[obj] = res[i] + res[num_objects + i]
         return pose_dic
 
     def get_obj_bounds(self, obj, return_cmd=False): # get object location
         cmd = f'vget /object/{obj}/bounds'
         if return_cmd:
             return cmd
-        res = None
-        while res is None:
-            res = self.client.request(cmd)
+        res = self._request_with_retry(cmd)
         return self.decoder.string2floats(res)  # min x,y,z  max x,y,z
 
-    def get_obj_size(self, obj, box=True):
+    def get_obj_size(self, obj, box=True, use_cache=True):
         # return the size of the bounding box
-        self.set_obj_rotation(obj, [0, 0, 0])  # init
-        bounds = self.get_obj_bounds(obj)
-        x = bounds[3] - bounds[0]
-        y = bounds[4] - bounds[1]
-        z = bounds[5] - bounds[2]
+        # the object is reset to rotation [0, 0, 0] on every call, cached or not, the bounds are measured in that pose
+        # the size only depends on the scale, so it is cached until the scale is set again
+        self.set_obj_rotation(obj, [0, 0, 0])  # init, queued without a round trip
+        if use_cache and (obj, 'size') in self._attr_cache:
+            [x, y, z] = self._attr_cache[(obj, 'size')]
+        else:
+            bounds = self.get_obj_bounds(obj)
+            x = bounds[3] - bounds[0]
+            y = bounds[4] - bounds[1]
+            z = bounds[5] - bounds[2]
+            self._attr_cache[(obj, 'size')] = [x, y, z]
         if box:
             return [x, y, z]
         else:
             return x*y*z
 
-    def get_obj_scale(self, obj, return_cmd=False):
-        # set object scale
+    def get_obj_scale(self, obj, return_cmd=False, use_cache=True):
+        # get object scale, the cached value is returned unless use_cache=False
         cmd = f'vget /object/{obj}/scale'
         if return_cmd:
             return cmd
-        res = None
-        while res is None:
-            res = self.client.request(cmd)
-        print(obj, res)
-        return self.decoder.string2floats(res)  # [scale_x, scale_y, scale_z]
+        if use_cache and (obj, 'scale') in self._attr_cache:
+            return list(self._attr_cache[(obj, 'scale')])
+        res = self._request_with_retry(cmd)
+        scale = self.decoder.string2floats(res)  # [scale_x, scale_y, scale_z]
+        self._attr_cache[(obj, 'scale')] = scale
+        return list(scale)
 
     def set_obj_scale(self, obj, scale=[1, 1, 1], return_cmd=False):
         # set object scale
         [x, y, z] = scale
-        cmd = f'vset /object/{obj}/scale {x} {y} {z}'
+        cmd = f'vset /object/{obj}/scale {x:.6f} {y:.6f} {z:.6f}'  # fixed point, the server does not parse exponents such as 1e+06
+        self._attr_cache[(obj, 'scale')] = [x, y, z]
+        self._attr_cache.pop((obj, 'size'), None)
         if return_cmd:
             return cmd
-        self.client.request(cmd, -1)
+        self._issue(cmd)
 
     def set_hide_obj(self, obj, return_cmd=False):  # hide an object, make it invisible, but still there in physics engine
         cmd = f'vset /object/{obj}/hide'
         if return_cmd:
             return cmd
-        self.client.request(cmd, -1)
+        self._issue(cmd)
 
     def set_show_obj(self, obj, return_cmd=False):  # show an object, make it visible
         cmd = f'vset /object/{obj}/show'
         if return_cmd:
             return cmd
-        self.client.request(cmd, -1)
+        self._issue(cmd)
+
+    def _bulk(self, action, objects, args=''):  # the same vset command for a list of objects
+        return [f'vset /object/{obj}/{action}{args}' for obj in objects]
 
     def set_hide_objects(self, objects):
-        cmds = [self.set_hide_obj(obj, return_cmd=True) for obj in objects]
-        self.client.request(cmds, -1)
+        self._issue(self._bulk('hide', objects))
 
     def set_show_objects(self, objects):
-        cmds = [self.set_show_obj(obj, return_cmd=True) for obj in objects]
-        self.client.request(cmds, -1)
+        self._issue(self._bulk('show', objects))
+
+    def set_objects_scale(self, objects, scale=[1, 1, 1]):  # set the same scale for a list of objects
+        objects = list(objects)
+        [x, y, z] = scale
+        self._issue(self._bulk('scale', objects, f' {x:.6f} {y:.6f} {z:.6f}'))  # same format as set_obj_scale
+        for obj in objects:
+            self._attr_cache[(obj, 'scale')] = [x, y, z]
+            self._attr_cache.pop((obj, 'size'), None)
+
+    def destroy_objects(self, objects):  # destroy a list of objects
+        objects = list(objects)
+        self._issue(self._bulk('destroy', objects))
+        for obj in objects:
+            self._forget_obj(obj)
 
     def destroy_obj(self, obj): # destroy an object, remove it from the scene
-        self.client.request(f'vset /object/{obj}/destroy', -1)
+        self._issue(f'vset /object/{obj}/destroy')
+        self._forget_obj(obj)
+
+    def _forget_obj(self, obj):  # remove a destroyed object from the local caches
         self.obj_dict.pop(obj)
+        self._mask_ranges.pop(obj, None)
+        self._obj_pose.pop(obj, None)
+        self.invalidate(obj)
+        if self._objects is not None and obj in self._objects:
+            self._objects.remove(obj)
         # TODO: remove the cameras mounted at the object
 
-    def get_camera_num(self):
+    def get_camera_num(self, use_cache=True):
+        if use_cache and self._num_cameras is not None:
+            return self._num_cameras
         res = self.client.request('vget /cameras')
-        return len(res.split())
+        self._num_cameras = len(res.split())
+        return self._num_cameras
 
     def get_camera_list(self):
         res = self.client.request('vget /cameras')
@@ -517,52 +848,67 @@ class UnrealCv_API(object):
 
     def set_new_camera(self):
         res = self.client.request('vset /cameras/spawn')
+        self._num_cameras = None  # the number of cameras is changed
         cam_id = len(self.cam)
         self.register_camera(cam_id)
         return res   # return the object name of the new camera
 
     def register_camera(self, cam_id, obj_name=None):
+        cmds = [self.get_cam_location(cam_id, return_cmd=True),
+                self.get_cam_rotation(cam_id, return_cmd=True),
+                self.get_cam_fov(cam_id, return_cmd=True)]
+        decoders = [self.decoder.string2floats, self.decoder.string2floats, self.decoder.string2float]
+        [location, rotation, fov] = self.batch_cmd(cmds, decoders)
         self.cam[cam_id] = dict(
             obj_name=obj_name,
-            location=self.get_cam_location(cam_id, syns=False),
-            rotation=self.get_cam_rotation(cam_id, syns=False),
-            fov=self.get_cam_fov(cam_id),
+            location=location,
+            rotation=rotation,
+            fov=fov,
         )
 
     def set_new_obj(self, class_name, obj_name):
-        cmd = f'vset /object/spawn {class_name} {obj_name}'
-        res = self.client.request(cmd)
+        # reserve a random color locally and send it along with the spawn command, one round trip for both
+        color = [int(c) for c in np.random.randint(0, 255, 3)]
+        while self.pack_color(color) in self._used_colors:
+            color = [int(c) for c in np.random.randint(0, 255, 3)]
+        old_color = self.obj_dict.get(obj_name)
+        cmds = [f'vset /object/spawn {class_name} {obj_name}', self.set_obj_color(obj_name, color, return_cmd=True)]
+        res, _ = self.client.request(cmds)
         if self.checker.is_error(res):
             warnings.warn(res)
+            # release the reserved color
+            self._used_colors.discard(self.pack_color(color))
+            if old_color is None:
+                self.obj_dict.pop(obj_name)
+                self._mask_ranges.pop(obj_name, None)
+            else:
+                self.obj_dict[obj_name] = old_color
+                self._mask_ranges[obj_name] = self.build_mask_range(old_color)
         else:  # add object to the object list, check if new cameras are added
-            # assign a random color to the object
-            color = np.random.randint(0, 255, 3)
-            used_colors = self.obj_dict.values()
-            while color in used_colors:
-                color = np.random.randint(0, 255, 3)
-            self.obj_dict[obj_name] = color
-            self.set_obj_color(obj_name, color)
-            # check if new cameras are added
-            while len(self.cam) < self.get_camera_num():
-                self.register_camera(len(self.cam), obj_name)
+            self.invalidate(obj_name)  # the name may be reused from a destroyed object
+            if self._objects is not None:
+                self._objects.append(obj_name)
+            num_cameras = self.get_camera_num(use_cache=False)
+            for cam_id in range(len(self.cam), num_cameras):
+                self.register_camera(cam_id, obj_name)
             return obj_name
 
     def get_vertex_locations(self, obj, return_cmd=False):
         cmd = f'vget /object/{obj}/vertex_location'
         if return_cmd:
             return cmd
-        res = None
-        while res is None:
-            res = self.client.request(cmd)
+        res = self._request_with_retry(cmd)
         return self.decoder.decode_vertex(res)
 
-    def get_obj_uclass(self, obj, return_cmd=False):
+    def get_obj_uclass(self, obj, return_cmd=False, use_cache=True):
+        # the class of an object never changes, so it is only queried once
         cmd = f'vget /object/{obj}/uclass_name'
         if return_cmd:
             return cmd
-        res = None
-        while res is None:
-            res = self.client.request(cmd)
+        if use_cache and (obj, 'uclass') in self._attr_cache:
+            return self._attr_cache[(obj, 'uclass')]
+        res = self._request_with_retry(cmd)
+        self._attr_cache[(obj, 'uclass')] = res
         return res
 
     def set_map(self, map_name, return_cmd=False):  # change to a new level map
@@ -571,7 +917,7 @@ class UnrealCv_API(object):
             return cmd
         res = self.client.request(cmd)
         if self.checker.not_error(res):
-            self.init_map()
+            self.refresh_map()
 
     def set_pause(self, return_cmd=False):
         cmd = f'vset /action/game/pause'
@@ -593,18 +939,55 @@ class UnrealCv_API(object):
         cmd = f'vrun slomo {time_dilation}'
         if return_cmd:
             return cmd
-        self.client.request(cmd, -1)
+        self._issue(cmd)
 
     def set_max_FPS(self, max_fps, return_cmd=False):
         cmd = f'vrun t.maxFPS {max_fps}'
         if return_cmd:
             return cmd
-        self.client.request(cmd, -1)
+        self._issue(cmd)
+
+
+class ImageStream(object):
+    # iterator of the images returned by get_image_multicam_stream, in the order of the requests
+    # the remaining responses are read and dropped when the stream is closed or garbage collected,
+    # so that they are never returned to the next request, even if the stream was never iterated
+    def __init__(self, responses, decode_async):
+        self.responses = responses  # unrealcv.BatchResponses
+        self.decode_async = decode_async  # response -> Future of the image
+        self.futures = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for res in self.responses:  # decode the received responses until the first image is ready
+            self.futures.append(self.decode_async(res))
+            if self.futures[0].done():
+                break
+        if not self.futures:
+            raise StopIteration
+        return self.futures.popleft().result()
+
+    def close(self):
+        self.responses.close()
+        self.futures.clear()
+
+    def __del__(self):
+        self.close()
+
+
+# precompiled regexes used by MsgDecoder
+_RE_NUMBER = re.compile(r"\d+\.?\d*")
+_RE_SIGNED_NUMBER = re.compile(r"[+-]?\d+\.?\d*")
+_RE_BP_NUMBER = re.compile(r'"([\d]+\.?\d*)"')
+_RE_BP_VECTOR = re.compile(r'([XYZ]=\d+\.\d+)')
 
 
 class MsgDecoder(object):
     def __init__(self, resolution):
-        self.resolution = resolution
+        self.resolution = resolution  # also precomputes the image shapes, see the setter
+        self.checker = ResChecker()
         self.decode_map = {
             'vertex_location': self.decode_vertex,
             'color': self.string2color,
@@ -612,91 +995,130 @@ class MsgDecoder(object):
             'location': self.string2floats,
             'bounds': self.string2floats,
             'scale': self.string2floats,
+            'fov': self.string2float,
             'png': self.decode_png,
             'bmp': self.decode_bmp,
+            'jpg': self.decode_jpg,
             'npy': self.decode_npy
         }
 
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, resolution):  # precompute the sizes used for every frame
+        [w, h] = resolution[:2]
+        self._resolution = resolution
+        self._pixels = w * h
+        self._depth_shape = (h, w, 1)
+
     def cmd2key(self, cmd):  # extract the last word of the command as key
-        return re.split(r'[/\s]+', cmd)[-1]
+        return cmd.rsplit(None, 1)[-1].rsplit('/', 1)[-1]  # last token, then the part after its last slash
 
-    def decode(self, cmd, res):  # universal decode function
-        key = self.cmd2key(cmd)
-        decode_func = self.decode_map.get(key)
-        return decode_func(res)
+    def decode(self, cmd, res, key=None):  # universal decode function, pass key to skip parsing the command
+        if key is None:
+            key = self.cmd2key(cmd)
+        return self.decode_map[key](res)
 
     def string2list(self, res):
         return res.split()
 
     def string2floats(self, res):  # decode number
-        return [float(i) for i in res.split()]
+        return [float(i) for i in res.split()]  # faster than np.fromstring or a regex for short replies
+
+    def string2floats_np(self, res):  # decode numbers into a numpy array, parsed in C
+        return np.fromstring(res, dtype=np.float64, sep=' ')
+
+    def string2float(self, res):  # decode a single number
+        return float(res)
 
     def string2color(self, res):  # decode color
-        object_rgba = re.findall(r"\d+\.?\d*", res)
-        color = [int(i) for i in object_rgba]  # [r,g,b,a]
-        return color[:-1]  # [r,g,b]
+        object_rgba = _RE_NUMBER.findall(res)  # [r,g,b,a]
+        return list(map(int, object_rgba[:3]))  # [r,g,b], alpha is dropped before converting
+
+    def strings2colors(self, res_list):  # decode a batch of colors with one regex pass over all replies
+        values = list(map(int, _RE_NUMBER.findall(' '.join(res_list))))
+        if len(values) != 4 * len(res_list):  # e.g. an error reply, decode one by one to keep the alignment
+            return [self.string2color(res) for res in res_list]
+        return [values[i:i + 3] for i in range(0, len(values), 4)]  # [r,g,b], alpha is dropped
 
     def string2vector(self, res):  # decode vector
-        res = re.findall(r"[+-]?\d+\.?\d*", res)
-        vector = [float(i) for i in res]
-        return vector
+        return list(map(float, _RE_SIGNED_NUMBER.findall(res)))
 
     def bpstring2floats(self, res):  # decode number
-        valuse = re.findall(r'"([\d]+\.?\d*)"', res)
+        valuse = _RE_BP_NUMBER.findall(res)
         if len(valuse) == 1:
             return float(valuse[0])
         else:
             return [float(i) for i in valuse]
     def bpvector2floats(self, res):  # decode number
-        values = re.findall(r'([XYZ]=\d+\.\d+)', res)
+        values = _RE_BP_VECTOR.findall(res)
         return [[float(i) for i in value] for value in values]
 
     def decode_vertex(self, res):  # decode vertex
-        # input: string
-        # output: list of list of floats
-        lines = res.split('\n')
-        lines = [line.strip() for line in lines]
-        vertex_locations = [list(map(float, line.split())) for line in lines]
-        return vertex_locations
+        # input: string, one "x y z" vertex per line
+        # output: numpy array of shape (num_vertex, 3), parsed in C instead of a python loop
+        if self.checker.is_error(res):  # np.fromstring would silently return an empty array
+            raise ValueError(f'Can not decode vertex locations from "{res}"')
+        vertices = self.string2floats_np(res)
+        if vertices.size % 3 != 0:
+            raise ValueError(f'Expect 3 floats per vertex, got {vertices.size} floats')
+        return vertices.reshape(-1, 3)
 
     def decode_img(self, res, mode, inverse=False):  # decode image
         if mode == 'png':
             img = self.decode_png(res)
         if mode == 'bmp':
             img = self.decode_bmp(res)
+        if mode == 'jpg':
+            img = self.decode_jpg(res)
         if mode == 'npy':
             img = self.decode_depth(res, inverse)
         return img
 
     def decode_png(self, res):  # decode png image
-        img = np.asarray(PIL.Image.open(BytesIO(res)))
-        img = img[:, :, :-1]  # delete alpha channel
-        img = img[:, :, ::-1]  # transpose channel order
-        return img
+        # decode straight from the response buffer to a contiguous BGR array, the alpha channel is dropped
+        return cv2.imdecode(np.frombuffer(res, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def decode_jpg(self, res):  # decode jpg image, lossy but much cheaper for the server to encode than png
+        return cv2.imdecode(np.frombuffer(res, dtype=np.uint8), cv2.IMREAD_COLOR)
 
     def decode_bmp(self, res, channel=4):  # decode bmp image
-        # TODO: configurable resolution
-        img = np.fromstring(res, dtype=np.uint8)
-        img = img[-self.resolution[1]*self.resolution[0]*channel:]
-        img = img.reshape(self.resolution[1], self.resolution[0], channel)
+        # the server sends uncompressed BGRA pixels after the bmp headers, so no decompression is needed
+        width, height = self.bmp_size(res)
+        img = np.frombuffer(res, dtype=np.uint8)  # view of the response buffer, no copy
+        img = img[-height*width*channel:]
+        img = img.reshape(height, width, channel)
         return img[:, :, :-1]  # delete alpha channel
 
+    def bmp_size(self, res):  # read (width, height) from the bmp info header, fall back to the configured resolution
+        if res[:2] == b'BM' and len(res) >= 26:
+            width, height = struct.unpack_from('<ii', res, 18)  # biWidth, biHeight
+            return width, abs(height)  # the server writes a negative height for top-down rows
+        return self.resolution[0], self.resolution[1]
+
     def decode_npy(self, res):  # decode npy image
-        img = np.load(BytesIO(res))
+        img = load_npy(res)
         if len(img.shape) == 2:
             img = np.expand_dims(img, axis=-1)
         return img
 
     def decode_depth(self, res, inverse=False, bytesio=True):  # decode depth image
         if bytesio:
-            depth = np.load(BytesIO(res))
+            depth = load_npy(res)
         else:
-            depth = np.fromstring(res, np.float32)
-            depth = depth[-self.resolution[1] * self.resolution[0]:]
-            depth = depth.reshape(self.resolution[1], self.resolution[0], 1)
+            # view the trailing pixels directly, frombuffer raises if the response is too short
+            depth = np.frombuffer(res, np.float32, count=self._pixels, offset=len(res) - self._pixels * 4)
+            depth = depth.reshape(self._depth_shape)
         if inverse:
-            depth = 1/depth
-        return np.expand_dims(depth, axis=-1)
+            if depth.flags.writeable and depth.dtype.kind == 'f':
+                depth = np.reciprocal(depth, out=depth)  # in place, no extra full-size array
+            else:
+                depth = 1/depth
+        if depth.ndim == 2:  # add the channel dim only if it is missing
+            depth = depth[..., None]
+        return depth
 
     def empty(self, res):
         return res
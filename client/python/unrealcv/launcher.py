@@ -6,6 +6,8 @@ import docker
 import time
 import sys
 import warnings
+import functools
+from pathlib import PurePath
 # api for launching UE4/5 binary
 
 
@@ -20,14 +22,17 @@ class RunUnreal():
             self.path2binary = os.path.abspath(os.path.join(self.path2env, self.env_bin))
         self.env_map = ENV_MAP
 
-        self.path2unrealcv = os.path.join(os.path.split(self.path2binary)[0], 'unrealcv.ini')
+        self.path2unrealcv = os.path.join(os.path.dirname(self.path2binary), 'unrealcv.ini')
+        self._ini_lines = None  # lines of unrealcv.ini, read once and written back by _flush_ini
         assert os.path.exists(self.path2binary), \
             'Please load env binary in UnrealEnv and Check the env_bin in setting file!'
 
     def start(self, docker=False, resolution=(160, 160), display=None, opengl=False, offscreen=False,
-              nullrhi=False, gpu_id=None, local_host=True, sleep_time=5):
+              nullrhi=False, gpu_id=None, local_host=True, sleep_time=5, scan_ports=False):
+        # scan_ports: if the configured port is busy, try the next ports one by one instead of asking the os for a free port
+        self._ini_lines = self._load_ini()  # the file may have been edited since the last start
         port = self.read_port()
-        self.write_resolution(resolution)
+        self.write_resolution(resolution, flush=False)
         self.use_docker = docker
 
         if display is not None:
@@ -38,9 +43,13 @@ class RunUnreal():
 
         if local_host:
             env_ip = '127.0.0.1'
-            while not self.isPortFree(env_ip, port):
-                port += 1
-                self.write_port(port)
+            if scan_ports:
+                port = self.scan_free_port(env_ip, port)
+                self.write_port(port, flush=False)  # only updates the cached lines
+            elif not self.isPortFree(env_ip, port):
+                port = self.get_free_port(env_ip)  # one bind instead of probing the ports one by one
+                self.write_port(port, flush=False)
+        self._flush_ini()  # write the port and resolution in one go
 
         if self.use_docker:
             self.docker = RunDocker(self.path2env)
@@ -49,7 +58,7 @@ class RunUnreal():
             print('Running nvidia-docker env')
         else:
             #self.modify_permission(self.path2env)
-            cmd_exe = [os.path.abspath(self.path2binary)]
+            cmd_exe = [self.path2binary]  # already made absolute in __init__
             self.set_ue_options(cmd_exe, opengl, offscreen, nullrhi, gpu_id)
 
             self.env = subprocess.Popen(cmd_exe, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
@@ -60,9 +69,24 @@ class RunUnreal():
             print('Running docker-free env, pid:{}'.format(self.env.pid))
 
         print('Please wait for a while to launch env......')
-        time.sleep(sleep_time)
+        if not self.wait_for_port(env_ip, port, timeout=sleep_time):  # return as soon as the server accepts connections
+            warnings.warn(f'The unrealcv server is not listening on {env_ip}:{port} after {sleep_time}s, the connection may fail')
         return env_ip, port
 
+    def wait_for_port(self, ip, port, timeout=5, interval=0.1):  # wait until the unrealcv server is listening
+        import socket
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.use_docker and self.env.poll() is not None:  # the binary exited, no need to wait
+                warnings.warn(f'The env exited with code {self.env.returncode}')
+                return False
+            try:
+                with socket.create_connection((ip, port), timeout=interval):
+                    return True
+            except OSError:
+                time.sleep(interval)
+        return False
+
     def set_ue_options(self, cmd_exe=[], opengl=False, offscreen=False, nullrhi=False, gpu_id=None):
         "some options for running UE env"
         if self.env_map is not None:
@@ -82,14 +106,15 @@ class RunUnreal():
         gympath = os.path.dirname(gym_unrealcv.__file__)
         return os.path.join(gympath, 'envs', 'UnrealEnv')
 
-    def parse_path(self, path):
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def parse_path(path):
         # parse the path to get the root path and the relative path to binary
-        part_path = path.split(os.sep)
+        # cached, parallel workers often open the same binary
+        part_path = PurePath(path).parts  # the first part is the root, e.g. '/' or 'C:\\'
         id_binaries = part_path.index('Binaries')
-        if not part_path[0].startswith('/'):
-            part_path[0] = '/' + part_path[0]
-        root_path = os.path.join(*part_path[:id_binaries-2])
-        binary_path = os.path.join(*part_path[id_binaries-2:])
+        root_path = str(PurePath(*part_path[:id_binaries-2]))
+        binary_path = str(PurePath(*part_path[id_binaries-2:]))
         return root_path, binary_path
 
     def close(self):  # close env
@@ -104,41 +129,69 @@ class RunUnreal():
         self.close()
 
     def modify_permission(self, path):
-        cmd = 'sudo chown {USER} {ENV_PATH} -R'
         username = getpass.getuser()
-        os.system(cmd.format(USER=username, ENV_PATH=path))
+        subprocess.run(['sudo', 'chown', username, path, '-R'])  # no shell, the path is passed as one argument
+
+    def _load_ini(self):  # read the lines of unrealcv.ini, None if it does not exist
+        if not os.path.exists(self.path2unrealcv):
+            return None
+        with open(self.path2unrealcv, 'r') as f:
+            return f.read().split('\n')
+
+    def _get_ini(self):
+        if self._ini_lines is None:
+            self._ini_lines = self._load_ini()
+        return self._ini_lines
+
+    def _flush_ini(self):  # write the cached lines back to unrealcv.ini
+        if self._ini_lines is not None:
+            with open(self.path2unrealcv, 'w') as f:
+                f.write('\n'.join(self._ini_lines))
 
     def read_port(self):  # read port number from unrealcv.ini
-        if os.path.exists(self.path2unrealcv):  # check unrealcv.ini exist
-            with open(self.path2unrealcv, 'r') as f:
-                s = f.read()  # read unrealcv.ini
-                ss = s.split()
-            return int(ss[1][-4:])  # return port number
+        ss = self._get_ini()
+        if ss is not None:  # check unrealcv.ini exist
+            return int(ss[1].split('=')[-1])  # return port number, Port=9000
         else:
             return 9000 # default port number
 
-    def write_port(self, port):  # write port number to unrealcv.ini
-        with open(self.path2unrealcv, 'r') as f:
-            s = f.read()
-            ss = s.split('\n')
-        with open(self.path2unrealcv, 'w') as f:
-            print(ss[1])
-            ss[1] = 'Port={port}'.format(port=port)
-            d = '\n'
-            s_new = d.join(ss)
-            f.write(s_new)
-
-    def write_resolution(self, resolution):  # set unrealcv camera resolution by writing unrealcv.ini
-        if os.path.exists(self.path2unrealcv):
-            with open(self.path2unrealcv, 'r') as f:
-                s = f.read()
-                ss = s.split('\n')
-            with open(self.path2unrealcv, 'w') as f:
-                ss[2] = 'Width={width}'.format(width=resolution[0])
-                ss[3] = 'Height={height}'.format(height=resolution[1])
-                d = '\n'
-                s_new = d.join(ss)
-                f.write(s_new)
+    def write_port(self, port, flush=True):  # write port number to unrealcv.ini
+        ss = self._get_ini()
+        if ss is None:
+            warnings.warn('unrealcv.ini is not found, the env will use the default port 9000')
+            return
+        ss[1] = 'Port={port}'.format(port=port)
+        if flush:
+            self._flush_ini()
+
+    def write_resolution(self, resolution, flush=True):  # set unrealcv camera resolution by writing unrealcv.ini
+        ss = self._get_ini()
+        if ss is not None:
+            ss[2] = 'Width={width}'.format(width=resolution[0])
+            ss[3] = 'Height={height}'.format(height=resolution[1])
+            if flush:
+                self._flush_ini()
+
+    def get_free_port(self, ip):  # let the os pick a free port
+        import socket
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((ip, 0))
+            return sock.getsockname()[1]
+
+    def scan_free_port(self, ip, port):  # return the first free port from port on
+        if 'linux' not in sys.platform:  # isPortFree also needs a connect on windows
+            while not self.isPortFree(ip, port):
+                port += 1
+            return port
+        import socket
+        # a failed bind leaves the socket unbound, so one socket is enough for the whole scan
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            while True:
+                try:
+                    sock.bind((ip, port))
+                    return port
+                except OSError:
+                    port += 1
 
     def isPortFree(self, ip, port):  # check port is free
         import socket
@@ -157,10 +210,15 @@ class RunUnreal():
 
 # run binary in docker
 class RunDocker():
+    _found_images = set()  # images known to be local, shared by all instances to skip listing the images again
+
     def __init__(self, path2env, image='zfw1226/unreal:latest'):
        self.docker_client = docker.from_env()
        self.check_image(target_images=image)
-       os.system('xhost +')
+       try:
+           subprocess.run(['xhost', '+'])
+       except FileNotFoundError:
+           warnings.warn('xhost is not found, the container may not be able to open a display')
        self.image = image
        self.path2env = path2env
 
@@ -171,6 +229,7 @@ class RunDocker():
               host_net=False
               ):
         path2binary = os.path.join(self.path2env, ENV_BIN)
+        self.host_net = host_net
         print(path2binary)
         if not os.path.exists(path2binary):
             warnings.warn('Did not find unreal environment, Please move your binary file to env/UnrealEnv')
@@ -178,29 +237,33 @@ class RunDocker():
 
         client = docker.from_env()
         # network_settings = self.container.attrs['NetworkSettings']
-        volumes = f'-v {self.path2env}:{ENV_DIR_DOCKER}:rw'
+        volumes = ['-v', f'{self.path2env}:{ENV_DIR_DOCKER}:rw']
 
         ENV_DIR_BIN_DOCKER = os.path.join(ENV_DIR_DOCKER, ENV_BIN)
         exe_cmd = ENV_DIR_BIN_DOCKER + ' ' + options
-        run_cmd = f'/bin/bash -c \"su user -c \'{exe_cmd}\'\"'
+        run_cmd = ['/bin/bash', '-c', f"su user -c '{exe_cmd}'"]
 
-        docker_cmd = 'docker run --gpus all  -e DISPLAY=$DISPLAY -e SDL_VIDEODRIVER=x11' \
-                     ' -v /tmp/.X11-unix:/tmp/.X11-unix:rw -v /usr/share/vulkan/icd.d:/usr/share/vulkan/icd.d ' \
-                     '-e QT_X11_NO_MITSHM=1 -e NVIDIA_DRIVER_CAPABILITIES=all --privileged -d -it'
+        # run docker directly without a shell, each option is one argument
+        docker_cmd = ['docker', 'run', '--gpus', 'all', '-e', f'DISPLAY={os.environ.get("DISPLAY", "")}',
+                      '-e', 'SDL_VIDEODRIVER=x11',
+                      '-v', '/tmp/.X11-unix:/tmp/.X11-unix:rw', '-v', '/usr/share/vulkan/icd.d:/usr/share/vulkan/icd.d',
+                      '-e', 'QT_X11_NO_MITSHM=1', '-e', 'NVIDIA_DRIVER_CAPABILITIES=all', '--privileged', '-d', '-it']
         if host_net:
-            docker_cmd += ' --net=host'
-        cmd = docker_cmd + ' ' + volumes + ' ' + self.image + ' ' + run_cmd
+            docker_cmd.append('--net=host')
+        cmd = docker_cmd + volumes + [self.image] + run_cmd
 
-        print(cmd)
-        os.system(cmd)
+        print(' '.join(cmd))
+        subprocess.run(cmd, check=True)
         self.container = self.docker_client.containers.list()[0]
 
         return self.get_ip()
 
     def get_ip(self):
-        # return '127.0.0.1'
-        print(self.container.attrs['NetworkSettings']['IPAddress'])
-        return self.container.attrs['NetworkSettings']['IPAddress']
+        if self.host_net:  # the container shares the host network and has no address of its own
+            return '127.0.0.1'
+        ip = self.container.attrs['NetworkSettings']['IPAddress']  # filled in by containers.list, no daemon call
+        print(ip)
+        return ip
 
     def get_path2UnrealEnv(self):
         import gym_unrealcv
@@ -212,17 +275,17 @@ class RunDocker():
 
     def check_image(self, target_images='zfw1226/unreal:latest'):
         # Check the existence of image
-        images = self.docker_client.images.list()
-        found_img = False
-        for i in range(len(images)):
-            if images[i].tags.count(target_images) > 0:
-                found_img = True
+        if target_images in RunDocker._found_images:
+            return
+        tags = {tag for image in self.docker_client.images.list() for tag in (image.tags or [])}
+        found_img = target_images in tags
         # Download image
         if found_img == False:
             warnings.warn('Do not found images, Downloading')
             self.docker_client.images.pull(target_images)
         else:
             print('Found images')
+        RunDocker._found_images.add(target_images)
 
 
 
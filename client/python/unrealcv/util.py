@@ -1,36 +1,54 @@
 import numpy as np
 import PIL.Image
 from io import BytesIO
+import ast
 import os
+import struct
 import time
+import functools
+try:
+    import pyspng  # optional, a faster png decoder than PIL
+except ImportError:
+    pyspng = None
 # StringIO module is removed in python3, use io module
 
 class ResChecker:
     # Define some utility functions to check whether the response is as expected
+    # binary replies (bytes/bytearray) are compared as bytes, without decoding them
     def is_error(self, res):
-        return (res is None) or res.startswith('error')
+        if res is None:
+            return True
+        if isinstance(res, (bytes, bytearray)):
+            return res[:5] == b'error'
+        return res.startswith('error')
 
     def is_ok(self, res):
-        return res == 'ok'
+        return res == 'ok' or res == b'ok'
 
     def not_error(self, res):
         return not self.is_error(res)
 
     def is_expected_file_extension(self, path, valid_ext):
         ext = os.path.splitext(path)[-1]
-        if ext not in valid_ext:
-            print(print(f'Invalid file extension {ext}, should be in {valid_ext}'))
-        return ext in valid_ext
+        if ext in valid_ext:
+            return True
+        print(f'Invalid file extension {ext}, should be in {valid_ext}')
+        return False
 
-def measure_fps(func, *args, **kwargs):
-    start_time = time.time()
-    for _ in range(60):
+def measure_fps(func, *args, warmup=5, iters=60, **kwargs):
+    # warmup: untimed calls first, the first calls may include connection and cache setup
+    # pass warmup=0 if the caller already warmed up, e.g. when measuring several modes back to back
+    for _ in range(warmup):
         func(*args, **kwargs)
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    fps = 60 / elapsed_time
+    start_time = time.perf_counter_ns()
+    for _ in range(iters):
+        func(*args, **kwargs)
+    elapsed_time = time.perf_counter_ns() - start_time
+    fps = iters * 1e9 / elapsed_time
     return fps
 
+_PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
 def read_png(res):
     '''
     Return a numpy array from binary bytes of png format
@@ -46,13 +64,44 @@ def read_png(res):
         Numpy array
     '''
     img = None
+    if not res or res[:8] != _PNG_MAGIC:  # e.g. an error message, skip the decoder
+        print('Read png can not parse response %s' % str(res[:20] if res else res))
+        return img
     try:
-        PIL_img = PIL.Image.open(BytesIO(res))
-        img = np.asarray(PIL_img)
+        if pyspng is not None:
+            img = pyspng.load(bytes(res))  # pyspng only accepts bytes
+        else:
+            PIL_img = PIL.Image.open(BytesIO(res))
+            img = np.asarray(PIL_img)
     except:
         print('Read png can not parse response %s' % str(res[:20]))
     return img
 
+def read_bmp(res):
+    '''
+    Return a numpy array from binary bytes of bmp format, without decoding
+
+    Parameters
+    ----------
+    res : bytes
+        For example, res = client.request('vget /camera/0/lit bmp')
+
+    Returns
+    -------
+    numpy.array
+        Numpy array of shape (height, width, 4) in BGRA order, a view of res
+    '''
+    img = None
+    try:
+        width, height = struct.unpack_from('<ii', res, 18)  # biWidth, biHeight of the info header
+        height = abs(height)  # the server writes a negative height, the rows are top-down
+        # the uncompressed pixels are at the end of the response
+        img = np.frombuffer(res, dtype=np.uint8, count=width * height * 4, offset=len(res) - width * height * 4)
+        img = img.reshape(height, width, 4)
+    except:
+        print('Read bmp can not parse response %s' % str(res[:20]))
+    return img
+
 def read_npy(res):
     '''
     Return a numpy array from binary bytes of numpy binary file format
@@ -70,25 +119,56 @@ def read_npy(res):
     # res is a binary buffer
     arr = None
     try:
-        arr = np.load(BytesIO(res))
+        arr = load_npy(res)
     except:
         print('Read npy can not parse response %s' % str(res[:20]))
     return arr
 
 
-def convert2planedepth(PointDepth, f=320): # convert point depth to plane depth
+def load_npy(res):
+    '''
+    Load an array from binary bytes of numpy binary file format, as a view of res when possible.
+    Parsing the header directly skips the file object and the copy done by np.load.
+    The array is read-only if res is bytes, writable if res is a bytearray (as returned by Client).
+    '''
+    if res[:6] == b'\x93NUMPY':
+        if res[6] == 1:  # version 1.0, 2 bytes header length
+            header_start, header_len = 10, int.from_bytes(res[8:10], 'little')
+        else:  # version 2.0 and 3.0, 4 bytes header length
+            header_start, header_len = 12, int.from_bytes(res[8:12], 'little')
+        dtype, shape, fortran_order = _parse_npy_header(bytes(res[header_start:header_start + header_len]))
+        if not fortran_order and not dtype.hasobject:
+            return np.frombuffer(res, dtype=dtype, offset=header_start + header_len).reshape(shape)
+    return np.load(BytesIO(res))  # fall back for the layouts the fast path does not handle
+
+@functools.lru_cache(maxsize=16)
+def _parse_npy_header(header):  # frames of a stream share the same header, so it is parsed once
+    header = ast.literal_eval(header.decode('latin1'))
+    return np.dtype(header['descr']), header['shape'], header['fortran_order']
+
+def convert2planedepth(PointDepth, f=320, out=None): # convert point depth to plane depth
     '''
     Convert point depth to plane depth
     f is half of the width of the image plane
+    out is an optional array to write the result into, e.g. PointDepth itself or a buffer reused across frames
     '''
     H = PointDepth.shape[0]
     W = PointDepth.shape[1]
-    i_c = np.float(H) / 2 - 1
-    j_c = np.float(W) / 2 - 1
-    columns, rows = np.meshgrid(np.linspace(0, W - 1, num=W), np.linspace(0, H - 1, num=H))
-    DistanceFromCenter = ((rows - i_c) ** 2 + (columns - j_c) ** 2) ** 0.5
-    PlaneDepth = PointDepth / (1 + (DistanceFromCenter / f) ** 2) ** 0.5
-    return PlaneDepth
+    inv = _plane_depth_factor(H, W, f)
+    if PointDepth.ndim == 3:  # depth with a channel dim, e.g. from decode_depth
+        inv = inv[..., None]
+    return np.multiply(PointDepth, inv, out=out)
+
+@functools.lru_cache(maxsize=8)
+def _plane_depth_factor(H, W, f):  # the per-pixel factor only depends on the image size and f, compute it once
+    i_c = float(H) / 2 - 1
+    j_c = float(W) / 2 - 1
+    rows = (np.arange(H, dtype=np.float64) - i_c) ** 2
+    columns = (np.arange(W, dtype=np.float64) - j_c) ** 2
+    inv = 1 / np.sqrt(1 + (rows[:, None] + columns[None, :]) / f ** 2)
+    inv = inv.astype(np.float32)
+    inv.flags.writeable = False  # shared between calls
+    return inv
 
 def time_it(func):
     def wrapper(*args, **kwargs):
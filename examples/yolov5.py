@@ -4,22 +4,57 @@ To install YOLOv5, you can refer to this page: https://pytorch.org/hub/ultralyti
 '''
 
 import unrealcv
-from unrealcv.util import read_png
+from unrealcv.util import read_bmp
 import torch
 import cv2
+import queue
+import threading
 
 if __name__ == '__main__':
     client = unrealcv.Client(('localhost', 9000))  # config the port according to your setting
     client.connect()
     model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
+    if torch.cuda.is_available():
+        model = model.cuda().half()  # fp16 on gpu, roughly doubles the throughput on recent gpus
+        torch.backends.cudnn.benchmark = True  # the frame size is fixed, so the conv algorithms are picked once
+    model.eval()
+
+    # capture the next frame in a thread while the current one is on the gpu
+    frames = queue.Queue(maxsize=2)
+    running = threading.Event()
+    running.set()
+
+    def producer():
+        try:
+            while running.is_set():
+                # bmp is sent uncompressed, so neither the server nor the client spends time on png encoding
+                res = client.request('vget /camera/0/lit bmp')
+                if res is None:  # the connection is lost
+                    break
+                img = read_bmp(res)
+                if img is None:  # e.g. an error reply, read_bmp already printed it
+                    continue
+                frames.put(cv2.cvtColor(img, cv2.COLOR_BGRA2RGB))
+        finally:
+            frames.put(None)  # tell the main loop that no more frames will come
+
+    capture_thread = threading.Thread(target=producer, daemon=True)
+    capture_thread.start()
     for i in range(1000):
-        res = client.request('vget /camera/0/lit png')
-        img = read_png(res)
-        results = model([img])
+        img = frames.get()
+        if img is None:  # the producer stopped, e.g. the connection is lost
+            break
+        with torch.inference_mode():
+            results = model([img])  # one frame per call to keep the display real-time, pass a list of frames to batch
         img = results.render()[0]
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        cv2.imshow('img', img)
+        cv2.imshow('img', img[..., ::-1])  # rgb to bgr as a view, no cvtColor copy
         if cv2.waitKey(20) & 0xFF == ord('q'):
             break
+    running.clear()
+    while capture_thread.is_alive():  # drain the queue, the producer may be waiting on a full queue
+        try:
+            frames.get(timeout=0.1)
+        except queue.Empty:
+            pass
     client.disconnect()
 
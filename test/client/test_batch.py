@@ -0,0 +1,153 @@
+'''
+Test the batched and streamed requests of unrealcv.Client and UnrealCv_API against a fake server
+Each test starts its own server, which replies to every request with reply(cmd)
+'''
+import asyncio, socket, threading, time
+import cv2
+import numpy as np
+import pytest
+import unrealcv
+from unrealcv.api import UnrealCv_API
+
+localhost = 'localhost'
+
+def serve(reply):
+    ''' Start a fake unrealcv server on a free port, return the port and the list of received commands '''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind((localhost, 0))
+    server.listen(1)
+    received = []
+
+    def _():
+        conn, _addr = server.accept()
+        unrealcv.SocketMessage.WrapAndSendPayload(conn, b'connected to Python Fake Server')
+        while True:
+            payload = unrealcv.SocketMessage.ReceivePayload(conn)
+            if not payload:
+                break
+            message_id, cmd = payload.split(b':', 1)
+            received.append(cmd.decode())
+            unrealcv.SocketMessage.WrapAndSendPayload(conn, message_id + b':' + reply(cmd.decode()))
+        conn.close()
+        server.close()
+
+    threading.Thread(target=_, daemon=True).start()
+    return server.getsockname()[1], received
+
+def echo(cmd):
+    return cmd.encode()
+
+def image_reply(cmd):
+    ''' Reply a png image to image requests, whose pixels are the camera id, echo the other requests '''
+    if cmd.startswith('vget /camera/'):
+        cam_id = int(cmd.split('/')[2])
+        return cv2.imencode('.png', np.full((3, 4, 3), cam_id, dtype=np.uint8))[1].tobytes()
+    if cmd in ('vget /cameras', 'vget /objects'):
+        return b''
+    return echo(cmd)
+
+@pytest.fixture
+def api():
+    port, _ = serve(image_reply)
+    api = UnrealCv_API(port, localhost, (4, 3))
+    yield api
+    api.close()
+
+def test_multicam_stream(api):
+    images = list(api.get_image_multicam_stream([0, 1, 2], mode='png'))
+    assert [int(img[0, 0, 0]) for img in images] == [0, 1, 2]
+
+def test_multicam_stream_dropped(api):
+    ''' The responses of a stream dropped before its first image must not be returned to the next request '''
+    stream = api.get_image_multicam_stream([0, 1, 2], mode='png')
+    del stream
+    assert api.client.request('vget /unrealcv/status') == 'vget /unrealcv/status'
+
+def test_multicam_stream_closed(api):
+    stream = api.get_image_multicam_stream([0, 1, 2], mode='png')
+    assert int(next(stream)[0, 0, 0]) == 0
+    stream.close()
+    assert api.client.request('vget /unrealcv/status') == 'vget /unrealcv/status'
+
+def color_reply(cmd):
+    ''' Reply the object list and the object colors, echo the other requests '''
+    if cmd == 'vget /cameras':
+        return b''
+    if cmd == 'vget /objects':
+        return b'Cube Sphere'
+    if cmd == 'vget /object/Cube/color':
+        return b'(R=10,G=20,B=30,A=255)'
+    if cmd == 'vget /object/Sphere/color':
+        return b'(R=200,G=100,B=3,A=255)'
+    return echo(cmd)
+
+@pytest.mark.parametrize('batch', [True, False])
+def test_build_color_dict(batch):
+    port, _ = serve(color_reply)
+    api = UnrealCv_API(port, localhost, (4, 3))
+    try:
+        color_dict = api.build_color_dict(['Cube', 'Sphere'], batch=batch)
+        assert color_dict == {'Cube': [10, 20, 30], 'Sphere': [200, 100, 3]}
+        assert api.get_obj_color('Cube') == [10, 20, 30]
+    finally:
+        api.close()
+
+@pytest.fixture
+def echo_client():
+    port, received = serve(echo)
+    client = unrealcv.Client((localhost, port))
+    client.connect()
+    yield client, received
+    client.disconnect()
+
+def test_submit_order(echo_client):
+    ''' Submitted commands reach the server before the next request, in call order '''
+    client, received = echo_client
+    client.flush_interval = 10  # only the request sends them
+    client.submit('vset /a')
+    client.submit(['vset /b', 'vset /c'])
+    assert client.request('vget /d') == 'vget /d'
+    assert received == ['vset /a', 'vset /b', 'vset /c', 'vget /d']
+
+def test_submit_flush(echo_client):
+    client, received = echo_client
+    client.flush_interval = 10
+    client.submit(['vset /a', 'vset /b'])
+    client.flush()
+    assert client.request_batch(['vget /c', 'vget /d']) == ['vget /c', 'vget /d']
+    assert received == ['vset /a', 'vset /b', 'vget /c', 'vget /d']
+
+def test_submit_flush_thread(echo_client):
+    client, received = echo_client
+    client.submit('vset /a')
+    for _ in range(100):  # wait up to 1s for the flush thread
+        if received:
+            break
+        time.sleep(0.01)
+    assert received == ['vset /a']
+
+def test_flush_failed(echo_client):
+    ''' A failed send keeps the submitted commands queued and the message ids in step '''
+    client, received = echo_client
+    client.flush_interval = 10
+    client.submit(['vset /a', 'vset /b'])
+    client.send_batch = lambda messages: False
+    with pytest.raises(AssertionError):
+        client.flush()
+    assert list(client.submit_q) == ['vset /a', 'vset /b']
+    assert client.send_message_id == 0
+    del client.send_batch
+    assert client.request('vget /c') == 'vget /c'
+    assert received == ['vset /a', 'vset /b', 'vget /c']
+
+def test_request_batch_iter(echo_client):
+    client, received = echo_client
+    responses = client.request_batch_iter(['vget /a', 'vget /b', 'vget /c'])
+    assert next(responses) == 'vget /a'
+    responses.close()
+    assert client.request('vget /d') == 'vget /d'
+    assert list(client.request_batch_iter(['vget /e', 'vget /f'])) == ['vget /e', 'vget /f']
+
+def test_multicam_async(api):
+    images = asyncio.run(api.get_image_multicam_async([0, 1], mode='png'))
+    assert [int(img[0, 0, 0]) for img in images] == [0, 1]
@@ -4,28 +4,32 @@ These tests can not verify whether the results are generated correctly, since we
 
 Every test function starts with prefix `test_`, so that pytest can automatically discover these functions during execution.
 '''
-import time
 
 import unrealcv
-from unrealcv import client
+from unrealcv.util import read_png, load_npy
 from conftest import checker, ver
 import numpy as np
 import pytest
-from io import BytesIO
 import os, re
+import functools
 try:
     import cv2
     no_opencv = False
 except ImportError:
     no_opencv = True
 
+_CONFIG_RE = re.compile(r'Config file: (.+?)\n')
+
 def imread_png(res):
-    import PIL.Image
-    PILimg = PIL.Image.open(BytesIO(res))
-    return np.array(PILimg)
+    img = read_png(res)  # uses pyspng when it is installed, PIL otherwise
+    assert img is not None, 'Can not decode the png response'
+    return img
+
+def imread_jpg(res):
+    return cv2.imdecode(np.frombuffer(res, dtype=np.uint8), cv2.IMREAD_COLOR)
 
 def imread_npy(res):
-    return np.load(BytesIO(res))
+    return load_npy(res)  # a view of the response, no copy
 
 def imread_file(res):
     if res[-3:] == 'npy':
@@ -35,84 +39,92 @@ def imread_file(res):
         return cv2.imread(res)
 
 
-def test_camera_control(cam_id=0):
-    client.connect()
+def test_camera_control(uc_client, cam_id=0):
     cmds = [
         f'vget /camera/{cam_id}/location',
         f'vget /camera/{cam_id}/rotation',
         # 'vset /camera/0/location 0 0 0', # BUG: If moved out the game bounary, the pawn will be deleted, so that the server code will crash with a nullptr error.
         # 'vset /camera/0/rotation 0 0 0',
     ]
-    for cmd in cmds:
-        res = client.request(cmd)
+    for res in uc_client.request_batch(cmds):  # one round trip for all commands
         assert checker.not_error(res)
 
 @pytest.mark.skipif(ver() < (0,3,7), reason = 'Png mode is implemented in v0.3.7')
-def test_png_mode(cam_id=0):
+def test_png_mode(uc_client, cam_id=0):
     '''
     Get image as a png binary, make sure no exception happened
     '''
-    client.connect()
     cmds = [
         f'vget /camera/{cam_id}/lit png',
         f'vget /camera/{cam_id}/object_mask png',
         f'vget /camera/{cam_id}/normal png',
     ]
-    for cmd in cmds:
-        res = client.request(cmd)
+    for res in uc_client.request_batch(cmds):
         assert checker.not_error(res)
         im = imread_png(res)
 
+@pytest.mark.skipif(ver() < (1,0,2), reason = 'Jpg mode is implemented in v1.0.2')
+@pytest.mark.skipif(no_opencv, reason = 'Can non find OpenCV')
+def test_jpg_mode(uc_client, cam_id=0):
+    '''
+    Get rgb images as a jpg binary, which is much cheaper for the server to encode than png.
+    The masks are not requested here, jpg is lossy and would break the object colors.
+    '''
+    cmds = [
+        f'vget /camera/{cam_id}/lit jpg',
+        f'vget /camera/{cam_id}/normal jpg',
+    ]
+    for cmd in cmds:
+        res = uc_client.request(cmd)
+        assert checker.not_error(res)
+        im = imread_jpg(res)
+        assert im is not None
+
 @pytest.mark.skipif(ver() < (0,3,8), reason = 'Npy mode is implemented in v0.3.8')
-def test_npy_mode(cam_id=0):
+def test_npy_mode(uc_client, cam_id=0):
     '''
     Get data as a numpy array
     '''
-    client.connect()
     cmd = f'vget /camera/{cam_id}/depth npy'
-    res = client.request(cmd)
+    res = uc_client.request(cmd)
     assert checker.not_error(res)
 
     # Do these but without assert, if exception happened, this test failed
     arr = imread_npy(res)
 
 @pytest.mark.skipif(no_opencv, reason = 'Can non find OpenCV')
-def test_file_mode(cam_id=0, show_img=True):
+def test_file_mode(uc_client, cam_id=0, show_img=bool(int(os.environ.get('UCV_SHOW', '0')))):
     ''' Save data to disk as image file '''
-    client.connect()
-    config_dir = get_config_dir()
+    config_dir = get_config_dir(uc_client)
     cmds = [
         f'vget /camera/{cam_id}/lit test.png',
         f'vget /camera/{cam_id}/object_mask test.png',
         f'vget /camera/{cam_id}/normal test.png',
         f'vget /camera/{cam_id}/depth test.npy',
     ]
-    for cmd in cmds:
-        res = client.request(cmd)
+    for res in uc_client.request_batch(cmds):
         assert checker.not_error(res)
         im = imread_file(os.path.join(config_dir, res))
-        if show_img:
+        if show_img:  # set UCV_SHOW=1 to check the images visually
             cv2.imshow('img', im)
             cv2.waitKey(10)
-            time.sleep(1)
 
 @pytest.mark.skipif(ver() < (0,3,8), reason = 'Npy mode is implemented in v0.3.8')
-def get_config_dir():
+@functools.lru_cache(maxsize=1)  # the config file does not move during a session
+def get_config_dir(uc_client):
     '''Get the directory of the unrealcv config file'''
-    client.connect()
-    res = client.request('vget /unrealcv/status')
-    config_file = re.search(r'Config file: (.+?)\n', res).group(1)
+    res = uc_client.request('vget /unrealcv/status')
+    config_file = _CONFIG_RE.search(res).group(1)
     config_directory = os.path.dirname(config_file)
     return config_directory
 
 @pytest.mark.skip(reason = 'Need to explicitly ignore this test for linux')
-def test_exr_file():
+def test_exr_file(uc_client):
     cmds = [
         'vget /camera/0/depth test.exr', # This is very likely to fail in Linux
     ]
-    client.connect()
     for cmd in cmds:
-        res = client.request(cmd)
+        res = uc_client.request(cmd)
         assert checker.not_error(res)
 
         im = imread_file(res)
@@ -124,8 +136,8 @@ if __name__ == '__main__':
     checker.not_error(res)
     camera_num = len(res.split())
     for cam_id in range(camera_num): # Test all cameras in the level
-        test_png_mode(cam_id)
-        test_npy_mode(cam_id)
-        test_file_mode(cam_id)
+        test_png_mode(unrealcv.client, cam_id)
+        test_npy_mode(unrealcv.client, cam_id)
+        test_file_mode(unrealcv.client, cam_id, show_img=False)
     unrealcv.client.disconnect()
     exit()
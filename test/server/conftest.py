@@ -23,6 +23,13 @@ class ResChecker:
 
 checker = ResChecker()
 
+@pytest.fixture(scope='session')
+def uc_client():
+    '''One connection shared by all tests of the session, instead of connecting in every test'''
+    client.connect()
+    yield client
+    client.disconnect()
+
 def ver():
     client.connect()
     res = client.request('vget /unrealcv/version')
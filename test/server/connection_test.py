@@ -10,17 +10,14 @@ def test_connection():
     assert checker.not_error(res)
     # assert res == 'ok'
 
-def test_echo():
-    client.connect()
-    res = client.request('vget /unrealcv/echo test')
+def test_echo(uc_client):
+    res = uc_client.request('vget /unrealcv/echo test')
     assert res == 'test'
 
-def test_viewmode():
+def test_viewmode(uc_client):
     viewmodes = ['lit', 'depth', 'object_mask', 'normal']
     for viewmode in viewmodes:
         cmd = 'vset /viewmode {viewmode}'.format(viewmode = viewmode)
         print(cmd)
-        res = client.request(cmd)
+        res = uc_client.request(cmd)
         assert checker.is_ok(res)
-    client.disconnect()
-    exit()
@@ -1,5 +1,4 @@
 # pytest -s stereo.py -k [name]
-from unrealcv import client
 import math, random
 from conftest import checker, ver
 import pytest
@@ -30,18 +29,16 @@ def approx(a, b, tol = 0.01):
     return abs(a - b) < tol
 
 @pytest.mark.skipif(ver() < (0, 3, 2), reason = 'eyes_distance is implemented before v0.3.2')
-def test_camera_distance():
-    client.connect()
-
+def test_camera_distance(uc_client):
     for test_distance in [20, 40, 60]:
-        res = client.request('vset /action/eyes_distance %d' % test_distance)
+        res = uc_client.request('vset /action/eyes_distance %d' % test_distance)
         assert checker.is_ok(res)
 
         for _ in range(5):
-            client.request('vset /camera/0/rotation %s' % str(random_vec3()))
-            actor_loc = Vec3(client.request('vget /actor/location'))
-            loc1 = Vec3(client.request('vget /camera/0/location'))
-            loc2 = Vec3(client.request('vget /camera/1/location'))
+            uc_client.request('vset /camera/0/rotation %s' % str(random_vec3()))
+            actor_loc = Vec3(uc_client.request('vget /actor/location'))
+            loc1 = Vec3(uc_client.request('vget /camera/0/location'))
+            loc2 = Vec3(uc_client.request('vget /camera/1/location'))
             print('%s %s %s' % (actor_loc, loc1, loc2))
 
             actual_dist = (loc1 - loc2).l2norm()
@@ -51,8 +48,7 @@ def test_camera_distance():
             assert approx(actor_cam0_distance, 0)
 
 @pytest.mark.skipif(ver() < (0, 3, 2), reason = 'pause is implemented before v0.3.2')
-def test_pause():
-    client.connect()
+def test_pause(uc_client):
     cmds = [
         'vset /action/game/pause',
         'vget /camera/0/lit',
@@ -60,7 +56,7 @@ def test_pause():
         'vset /action/game/pause',
     ]
     for cmd in cmds:
-        res = client.request(cmd)
+        res = uc_client.request(cmd)
         assert checker.not_error(res)
 
 if __name__ == '__main__':
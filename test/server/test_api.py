@@ -4,6 +4,7 @@ from unrealcv.api import UnrealCv_API
 from unrealcv.launcher import RunUnreal
 from unrealcv.util import measure_fps, parse_resolution
 import argparse
+import sys
 '''
 An example to show how to use the UnrealCV API to launch the game and run some functions
 '''
@@ -37,12 +38,16 @@ if __name__ == '__main__':
         env_ip, env_port = ue_binary.start(args.use_docker, parse_resolution(args.resolution), args.display, args.use_opengl, args.offscreen, args.nullrhi, str(args.gpu_id))
 
     # connect to the game
-    unrealcv = UnrealCv_API(env_port, env_ip, parse_resolution(args.resolution), 'tcp')  # 'tcp' or 'unix', 'unix' is only for local machine in Linux
+    # 'unix' skips the tcp stack for the image transfers, it is only for local machine in Linux
+    # the api falls back to tcp if the server does not create the unix socket
+    sock_mode = 'unix' if env_ip in ('127.0.0.1', 'localhost') and 'linux' in sys.platform else 'tcp'
+    unrealcv = UnrealCv_API(env_port, env_ip, parse_resolution(args.resolution), sock_mode)
     # unrealcv.config_ue(parse_res(args.resolution))
     # unrealcv.set_map(env_map)
 
     # Test the API
-    print(unrealcv.get_camera_num())
+    cam_num = unrealcv.get_camera_num()
+    print(cam_num)
     print(unrealcv.camera_info())
     objects = unrealcv.get_objects()
     t = time.time()
@@ -53,12 +58,19 @@ if __name__ == '__main__':
     print(unrealcv.get_obj_pose(objects[0]))
     print(unrealcv.get_obj_location(objects[0]))
     print(unrealcv.get_obj_rotation(objects[0]))
-    images = unrealcv.get_image_multicam(range(unrealcv.get_camera_num()))
-    for cam_id in range(unrealcv.get_camera_num()):
+    images = unrealcv.get_image_multicam(range(cam_num))
+    for cam_id in range(cam_num):
         for mode in ['lit', 'normal', 'seg', 'depth']:
-            unrealcv.get_image(cam_id, mode, show=True)
-            fps = measure_fps(unrealcv.get_image, cam_id, mode, show=args.show)
+            unrealcv.get_image(cam_id, mode, show=args.show)  # also warms up this camera and mode
+            if args.show:
+                fps = measure_fps(unrealcv.get_image, cam_id, mode, warmup=0, show=True)
+            else:  # the command and the decoder are resolved once, outside the timed loop
+                fps = measure_fps(unrealcv.make_image_fetcher(cam_id, mode), warmup=0)
             print(f'FPS for cam {cam_id}, mode {mode}: {fps}')
+    # all cameras and modes in one batch, the replies are decoded in the thread pool while the next ones arrive
+    # this is the throughput of a multi-camera capture, rather than the latency of a single image
+    fps = measure_fps(unrealcv.get_images_batch, range(cam_num), ['lit', 'normal', 'seg', 'depth'])
+    print(f'FPS for all cameras and modes in one batch: {fps}')
     unrealcv.client.disconnect()
     if not args.editor:
         ue_binary.close()